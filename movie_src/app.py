@@ -20,19 +20,25 @@ Chức năng chính:
   3. Mở trình duyệt tới http://127.0.0.1:5000 để xem trang.
 """
 
+import hmac
 import os
 import re
 import uuid
 from datetime import datetime
-import json
-import io
 import smtplib
+import threading
 from email.message import EmailMessage
 
-from flask import Flask, render_template, request, redirect, url_for, session, send_file, flash, jsonify
+import orjson
+from jinja2 import FileSystemBytecodeCache
+from flask import Flask, Response, abort, g, has_app_context, render_template, request, redirect, url_for, session, flash, jsonify, stream_with_context
+from flask_caching import Cache
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func, text
+from sqlalchemy import event, func, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import raiseload, selectinload
 
 # Tạo ứng dụng Flask
 app = Flask(__name__)
@@ -42,11 +48,23 @@ app = Flask(__name__)
 # giá trị này khi triển khai. Nếu không đặt, khóa mặc định sẽ được sử dụng.
 app.secret_key = os.environ.get("SECRET_KEY", "a-very-secret-key")
 
+# Mật khẩu upload đọc một lần lúc nạp module (biến môi trường không đổi trong
+# vòng đời tiến trình) thay vì tra os.environ ở mỗi lượt POST; lưu sẵn dạng
+# bytes để so sánh trực tiếp bằng hmac.compare_digest.
+UPLOAD_PASSWORD = os.environ.get("UPLOAD_PASSWORD", "secret").encode()
+
 # Thiết lập chuỗi kết nối cơ sở dữ liệu.  
 # Ứng dụng ưu tiên sử dụng biến môi trường DATABASE_URL để kết nối tới PostgreSQL
 # (hoặc các hệ quản trị cơ sở dữ liệu khác). Nếu biến này không tồn tại, ứng dụng
 # sẽ mặc định sử dụng SQLite trong thư mục ``data`` bên ngoài ``src`` để tiện
 # phát triển và thử nghiệm trên máy local.
+# Thư mục ``data`` nằm cùng cấp với thư mục mã nguồn: chứa file SQLite khi
+# phát triển local và các file tạm của chức năng import. Tính một lần ở cấp
+# module thay vì gọi lại os.path.abspath trong từng handler.
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+DATA_DIR = os.path.abspath(os.path.join(BASE_DIR, os.pardir, "data"))
+os.makedirs(DATA_DIR, exist_ok=True)
+
 db_url = os.environ.get("DATABASE_URL")
 if db_url:
     # Khi triển khai trên Render với PostgreSQL, bạn nên đặt DATABASE_URL trong phần
@@ -54,26 +72,83 @@ if db_url:
     # và External Database URL. Sử dụng Internal URL cho kết nối trong cùng
     # Render để tối ưu hiệu suất và bảo mật.
     app.config["SQLALCHEMY_DATABASE_URI"] = db_url
+    # Cấu hình pool kết nối tường minh cho PostgreSQL. Pool mặc định (5 kết
+    # nối, không kiểm tra trước) dễ gặp chu kỳ "đứt kết nối → chờ reconnect"
+    # khi máy chủ DB ngắt kết nối nhàn rỗi:
+    #   * pool_pre_ping: kiểm tra kết nối trước khi dùng, tránh lỗi giữa request.
+    #   * pool_recycle: thay kết nối sau 30 phút, trước khi server kịp ngắt.
+    #   * pool_use_lifo: ưu tiên tái dùng vài kết nối nóng gần nhất.
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_size": 10,
+        "max_overflow": 20,
+        "pool_pre_ping": True,
+        "pool_recycle": 1800,
+        "pool_use_lifo": True,
+    }
 else:
     # Cấu hình đường dẫn tới file cơ sở dữ liệu SQLite
     # Cơ sở dữ liệu được đặt trong thư mục ``data`` nằm cùng cấp với thư mục mã nguồn để tránh bị
-    # ghi đè khi cập nhật mã. Nếu thư mục không tồn tại, tự động tạo. Khi triển khai, bạn chỉ
-    # cần thay thế mã trong thư mục ``src`` mà không cần xoá thư mục ``data``.
-    BASE_DIR = os.path.abspath(os.path.dirname(__file__))
-    DATA_DIR = os.path.abspath(os.path.join(BASE_DIR, os.pardir, "data"))
-    os.makedirs(DATA_DIR, exist_ok=True)
+    # ghi đè khi cập nhật mã. Khi triển khai, bạn chỉ cần thay thế mã trong
+    # thư mục ``src`` mà không cần xoá thư mục ``data``.
     db_path = os.path.join(DATA_DIR, "stories.db")
     app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{db_path}"
 
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+# Lưới an toàn khi phát triển: đặt RAISELOAD_CHECK=1 để mọi quan hệ chưa được
+# nạp trước trong các truy vấn danh sách raise ngay (thay vì âm thầm phát sinh
+# truy vấn N+1 mà code review không nhìn thấy). Không bật ở môi trường chạy thật.
+app.config["RAISELOAD_CHECK"] = os.environ.get("RAISELOAD_CHECK") == "1"
+
 # Khởi tạo đối tượng SQLAlchemy
 db = SQLAlchemy(app)
 
+# Bộ nhớ đệm trong tiến trình cho các khối dữ liệu tổng hợp của trang chủ
+# (truyện nổi bật, truyện hay nhất, truyện mới cập nhật). Các danh sách này
+# thay đổi theo phút chứ không theo từng request, nên cache 60 giây giúp trang
+# chủ không phải chạy lại các truy vấn tổng hợp ở mỗi lượt xem. Khi triển khai
+# nhiều worker, có thể đặt CACHE_TYPE=RedisCache qua biến môi trường để các
+# worker dùng chung một cache.
+cache = Cache(app, config={"CACHE_TYPE": os.environ.get("CACHE_TYPE", "SimpleCache")})
+
+# Template không đổi trong vòng đời tiến trình khi chạy thật: tắt auto-reload
+# để Jinja khỏi stat file template ở mỗi lần render, và lưu bytecode đã biên
+# dịch vào DATA_DIR để worker gunicorn khởi động sau dùng lại thay vì biên
+# dịch từ đầu. Khi phát triển, đặt TEMPLATES_AUTO_RELOAD=1 để sửa template
+# vẫn thấy thay đổi ngay mà không cần khởi động lại.
+if os.environ.get("TEMPLATES_AUTO_RELOAD") == "1":
+    app.config["TEMPLATES_AUTO_RELOAD"] = True
+else:
+    app.config["TEMPLATES_AUTO_RELOAD"] = False
+    _jinja_cache_dir = os.path.join(DATA_DIR, "jinja_cache")
+    os.makedirs(_jinja_cache_dir, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(_jinja_cache_dir)
+
+
+def preload_templates() -> None:
+    """Biên dịch trước toàn bộ template lúc khởi động.
+
+    Nhờ đó request đầu tiên của mỗi worker không phải chịu phí biên dịch
+    Jinja, và bytecode cache trên đĩa được làm nóng sẵn cho các worker sau.
+    """
+    for name in app.jinja_env.list_templates(extensions=["html"]):
+        app.jinja_env.get_template(name)
+
+
+preload_templates()
+
 # Cung cấp đối tượng datetime cho tất cả template Jinja.
 # Điều này cho phép dùng {{ datetime.utcnow().year }} trong layout.html
 # mà không gặp lỗi UndefinedError.
 # Define a helper to convert Google Drive sharing links into embeddable preview URLs.
+# Biên dịch sẵn hai mẫu regex ở cấp module: drive_embed được gọi cho từng video
+# trong template nên không cần dịch lại (hay tra cache re) ở mỗi lần gọi.
+_DRIVE_FILE_RE = re.compile(r"/file/d/([A-Za-z0-9_-]+)")
+_DRIVE_ID_RE = re.compile(r"[?&]id=([A-Za-z0-9_-]+)")
+# Nhận diện đường dẫn /story/<id> trong url bình luận khi import (đổi id cũ sang id mới)
+_STORY_URL_RE = re.compile(r"/story/\d+")
+
+
 def drive_embed(url: str) -> str:
     """
     Convert a Google Drive sharing link into an embeddable preview URL.
@@ -92,15 +167,44 @@ def drive_embed(url: str) -> str:
     if not url:
         return ""
     # Match /file/d/<id>/ path
-    m = re.search(r"/file/d/([A-Za-z0-9_-]+)", url)
+    m = _DRIVE_FILE_RE.search(url)
     if not m:
         # Fallback: match id=... parameter
-        m = re.search(r"[?&]id=([A-Za-z0-9_-]+)", url)
+        m = _DRIVE_ID_RE.search(url)
     if m:
         fid = m.group(1)
         return f"https://drive.google.com/file/d/{fid}/preview"
     return ""
 
+# Danh sách thể loại gần như không đổi nhưng được truy vấn ở MỌI request
+# (context processor cho sidebar). Cache 5 phút ở cấp tiến trình; các thao tác
+# thêm/sửa/xoá thể loại và import dữ liệu sẽ xoá cache qua
+# invalidate_category_cache() nên admin luôn thấy thay đổi ngay.
+@cache.cached(timeout=300, key_prefix="categories:all")
+def _load_all_categories() -> list["Category"]:
+    """Truy vấn toàn bộ thể loại (được cache trong tiến trình)."""
+    return Category.query.all()
+
+
+def get_all_categories() -> list["Category"]:
+    """Trả về toàn bộ thể loại, memo hoá trong ``g`` cho request hiện tại.
+
+    Context processor và nhiều route cùng gọi helper này trong một lần render;
+    lớp memo theo request tránh lặp lại cả thao tác đọc cache lẫn unpickle.
+    """
+    cats = getattr(g, "_categories", None)
+    if cats is None:
+        cats = g._categories = _load_all_categories()
+    return cats
+
+
+def invalidate_category_cache() -> None:
+    """Xoá cache danh sách thể loại sau khi thể loại thay đổi."""
+    cache.delete("categories:all")
+    if has_app_context():
+        g.pop("_categories", None)
+
+
 # Helper to sort categories into special order for film site
 def get_category_groups() -> tuple[list["Category"], list["Category"], list["Category"]]:
     """
@@ -115,7 +219,7 @@ def get_category_groups() -> tuple[list["Category"], list["Category"], list["Cat
     Each group is sorted alphabetically (case-insensitive) except group 1 which preserves
     the order defined by the candidate lists.
     """
-    cats = Category.query.all()
+    cats = get_all_categories()
     first_candidates_1 = ["Phim Chỉ Có 1 Tập", "Truyện Chỉ Có 1 Chương"]
     first_candidates_2 = ["Phim Có Nhiều Tập", "Truyện Có Nhiều Chương"]
     group1: list[Category] = []
@@ -143,7 +247,7 @@ def get_sorted_categories() -> list["Category"]:
     This fallback allows templates or routes that reference ``get_sorted_categories``
     to continue working without raising ``NameError``.
     """
-    return sorted(Category.query.all(), key=lambda c: c.name.lower())
+    return sorted(get_all_categories(), key=lambda c: c.name.lower())
 
 
 # Provide utilities (datetime, range, drive_embed) to all Jinja templates.
@@ -188,6 +292,11 @@ class Story(db.Model):
     story_type = db.Column(db.String(10), nullable=False, default="short")
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    # thời điểm chương mới nhất được thêm (denormalize từ bảng parts) để
+    # danh sách "truyện mới cập nhật" chỉ cần ORDER BY trên cột có index
+    # thay vì GROUP BY + JOIN qua toàn bộ bảng parts ở mỗi lượt xem trang chủ
+    last_part_at = db.Column(db.DateTime, index=True)
+
     # số lượt xem, dùng để hiển thị top truyện
     views = db.Column(db.Integer, default=0)
 
@@ -204,6 +313,14 @@ class Story(db.Model):
     rating_sum = db.Column(db.Integer, default=0)
     rating_count = db.Column(db.Integer, default=0)
 
+    # cột sinh tự động (generated column) chứa điểm trung bình, để câu truy vấn
+    # "truyện hay nhất" sắp xếp trực tiếp trên cột có index thay vì tính biểu
+    # thức rating_sum / rating_count cho từng dòng mỗi lần tải trang chủ.
+    avg_rating = db.Column(
+        db.Float,
+        db.Computed("CAST(rating_sum AS FLOAT) / NULLIF(rating_count, 0)"),
+    )
+
     # khóa ngoại tới bảng thể loại (category). Đây là thể loại chính (có thể không
     # dùng nếu truyện thuộc nhiều thể loại). Khi sử dụng nhiều thể loại, cột này
     # có thể được đặt là None hoặc bằng ID của thể loại đầu tiên trong danh sách.
@@ -220,7 +337,39 @@ class Story(db.Model):
         secondary="story_categories",
         # Sử dụng backref khác tên để tránh xung đột với quan hệ một‑nhiều 'stories' trên Category
         backref=db.backref("stories_multi", lazy=True),
-        lazy="subquery",
+        # lazy="selectin": khi một truyện trong trang truy cập .categories,
+        # SQLAlchemy nạp thể loại cho TẤT CẢ truyện đã tải bằng một truy vấn
+        # IN (...) duy nhất, nên mọi route đều tránh được N+1 mà không cần
+        # nhớ thêm option eager-load.
+        lazy="selectin",
+    )
+
+    # Index phục vụ hai truy vấn nóng trên trang chủ: "truyện hay nhất"
+    # (lọc is_hidden, sắp theo avg_rating) và "truyện nổi bật" (lọc is_hidden,
+    # sắp theo views). Nhờ đó top-N chỉ cần quét một đoạn index thay vì quét
+    # và sắp xếp toàn bảng.
+    __table_args__ = (
+        db.Index("ix_stories_avg_rating", "is_hidden", "avg_rating"),
+        db.Index("ix_stories_hidden_views", "is_hidden", "views"),
+        # danh sách truyện ngắn/dài: lọc story_type rồi sắp theo created_at —
+        # index một phần (chỉ chứa truyện đang hiển thị) nhỏ hơn index tổng
+        # hợp cũ và cho phép quét đoạn index theo đúng thứ tự sắp xếp
+        db.Index(
+            "ix_stories_type_created_visible",
+            "story_type",
+            created_at.desc(),
+            # viết điều kiện dưới dạng chữ để khớp đúng vị từ "is_hidden = 0"
+            # / "is_hidden = false" mà các truy vấn sinh ra (IS 0 không khớp)
+            sqlite_where=text("is_hidden = 0"),
+            postgresql_where=text("is_hidden = false"),
+        ),
+        # index hàm trên lower(title) để so khớp tiêu đề không phân biệt
+        # hoa/thường (kiểm tra trùng khi import) dùng B-tree thay vì quét bảng
+        db.Index("ix_stories_lower_title", func.lower(title)),
+        # đường tắt tìm theo tiền tố trong search(): lower(author) LIKE 'q%'
+        db.Index("ix_stories_lower_author", func.lower(author)),
+        # trang thể loại/tác giả lọc is_hidden rồi sắp theo created_at
+        db.Index("ix_stories_hidden_created", "is_hidden", "created_at"),
     )
 
     def __repr__(self) -> str:
@@ -244,6 +393,9 @@ story_categories = db.Table(
     "story_categories",
     db.Column("story_id", db.Integer, db.ForeignKey("stories.id"), primary_key=True),
     db.Column("category_id", db.Integer, db.ForeignKey("categories.id"), primary_key=True),
+    # khoá chính là (story_id, category_id) nên tra theo category_id một mình
+    # phải quét; index đảo chiều phục vụ join của trang thể loại
+    db.Index("ix_story_categories_cat_story", "category_id", "story_id"),
 )
 
 
@@ -256,6 +408,13 @@ class Part(db.Model):
     content = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    # index cho hai truy vấn nóng: lấy chương theo (story_id, part_number) ở
+    # trang chi tiết và GROUP BY story_id/MAX(created_at) cho "mới cập nhật"
+    __table_args__ = (
+        db.Index("ix_parts_story_partnum", "story_id", "part_number"),
+        db.Index("ix_parts_story_created", "story_id", "created_at"),
+    )
+
     def __repr__(self) -> str:
         return f"<Part {self.part_number} of Story {self.story_id}>"
 
@@ -279,6 +438,11 @@ class Comment(db.Model):
 
     story = db.relationship("Story", backref=db.backref("comments", lazy=True))
 
+    # index cho truy vấn lấy bình luận mới nhất của một truyện ở trang chi tiết
+    __table_args__ = (
+        db.Index("ix_comments_story_created", "story_id", "created_at"),
+    )
+
     def __repr__(self) -> str:
         return f"<Comment {self.id} on Story {self.story_id}>"
 
@@ -312,37 +476,233 @@ class PartVideo(db.Model):
         return f"<PartVideo {self.id} for Part {self.part_id}>"
 
 
-# Khi module được import (dù bởi flask CLI hay chạy trực tiếp),
-# đảm bảo rằng các bảng trong SQLite được tạo. Thực hiện trong
-# app context để tránh lỗi "no such table" khi truy cập lần đầu.
+def upgrade_db():
+    """
+    Kiểm tra và thêm các cột mới vào bảng stories nếu chúng chưa tồn tại.
+
+    Khi cập nhật phiên bản mới, cơ sở dữ liệu cũ sẽ thiếu các cột như
+    `is_hidden`, `rating_sum`, `rating_count` và `is_completed`. Hàm này
+    sử dụng PRAGMA để kiểm tra thông tin bảng và thực hiện ALTER TABLE
+    nếu cần. Lưu ý: Chỉ áp dụng cho SQLite.
+    """
+    # engine.begin() gom tất cả ALTER/CREATE INDEX vào một transaction duy
+    # nhất nên SQLite chỉ phải fsync một lần thay vì một lần cho mỗi câu lệnh.
+    with db.engine.begin() as conn:
+        # Dùng table_xinfo thay vì table_info vì table_info không liệt kê
+        # các cột sinh tự động (generated column) như avg_rating.
+        result = conn.execute(text("PRAGMA table_xinfo(stories)")).fetchall()
+        columns = [row[1] for row in result]
+        if "is_hidden" not in columns:
+            conn.execute(text("ALTER TABLE stories ADD COLUMN is_hidden BOOLEAN DEFAULT 0"))
+        if "rating_sum" not in columns:
+            conn.execute(text("ALTER TABLE stories ADD COLUMN rating_sum INTEGER DEFAULT 0"))
+        if "rating_count" not in columns:
+            conn.execute(text("ALTER TABLE stories ADD COLUMN rating_count INTEGER DEFAULT 0"))
+        if "is_completed" not in columns:
+            conn.execute(text("ALTER TABLE stories ADD COLUMN is_completed BOOLEAN DEFAULT 0"))
+        if "avg_rating" not in columns:
+            # Cột sinh tự động; SQLite chỉ cho phép thêm dạng VIRTUAL qua ALTER TABLE
+            conn.execute(text(
+                "ALTER TABLE stories ADD COLUMN avg_rating FLOAT "
+                "GENERATED ALWAYS AS (CAST(rating_sum AS FLOAT) / NULLIF(rating_count, 0)) VIRTUAL"
+            ))
+        if "last_part_at" not in columns:
+            conn.execute(text("ALTER TABLE stories ADD COLUMN last_part_at DATETIME"))
+            # backfill từ bảng parts cho dữ liệu đã có
+            conn.execute(text(
+                "UPDATE stories SET last_part_at = "
+                "(SELECT MAX(created_at) FROM parts WHERE parts.story_id = stories.id)"
+            ))
+        # đảm bảo index tồn tại trên các CSDL đã tạo trước khi khai báo index
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_stories_avg_rating ON stories (is_hidden, avg_rating)"
+        ))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_stories_hidden_views ON stories (is_hidden, views)"
+        ))
+        # index một phần thay cho bản tổng hợp cũ (story_type, is_hidden,
+        # created_at): chỉ chứa truyện đang hiển thị nên nhỏ và nóng hơn
+        conn.execute(text("DROP INDEX IF EXISTS ix_stories_type_hidden_created"))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_stories_type_created_visible "
+            "ON stories (story_type, created_at DESC) WHERE is_hidden = 0"
+        ))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_parts_story_partnum ON parts (story_id, part_number)"
+        ))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_parts_story_created ON parts (story_id, created_at)"
+        ))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_comments_story_created ON comments (story_id, created_at)"
+        ))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_stories_last_part_at ON stories (last_part_at)"
+        ))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_stories_lower_title ON stories (lower(title))"
+        ))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_stories_lower_author ON stories (lower(author))"
+        ))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_stories_hidden_created ON stories (is_hidden, created_at)"
+        ))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_story_categories_cat_story "
+            "ON story_categories (category_id, story_id)"
+        ))
+
+
+def _part_search_vector():
+    """Biểu thức tsvector cho nội dung chương (phải khớp index GIN bên dưới)."""
+    return func.to_tsvector("simple", func.f_unaccent(func.coalesce(Part.content, "")))
+
+
+def _story_search_vector():
+    """Biểu thức tsvector cho tiêu đề + tác giả (phải khớp index GIN bên dưới)."""
+    return func.to_tsvector(
+        "simple",
+        func.f_unaccent(
+            func.coalesce(Story.title, "").concat(" ").concat(
+                func.coalesce(Story.author, "")
+            )
+        ),
+    )
+
+
+def upgrade_db_postgres() -> None:
+    """Nâng cấp lược đồ cho PostgreSQL: cột mới và các index chuyên biệt.
+
+    ``create_all`` chỉ tạo bảng chưa tồn tại chứ không ALTER bảng cũ, nên các
+    cột thêm sau này (last_part_at, avg_rating) phải được bổ sung ở đây cho
+    CSDL đã triển khai — tương tự vai trò của ``upgrade_db`` với SQLite.
+    Phần tìm kiếm dùng index biểu thức nên không cần thêm cột tsvector; biểu
+    thức trong truy vấn của route search phải trùng khớp để planner chọn
+    index. Nội dung được bỏ dấu bằng f_unaccent (bọc unaccent thành IMMUTABLE
+    để được phép dùng trong index) nên người dùng gõ không dấu vẫn tìm ra
+    kết quả.
+    """
+    with db.engine.begin() as conn:
+        # thêm cột mới cho bảng stories đã tồn tại (xem information_schema
+        # thay cho PRAGMA của SQLite); backfill chỉ chạy khi cột vừa được thêm
+        columns = {
+            row[0]
+            for row in conn.execute(text(
+                "SELECT column_name FROM information_schema.columns "
+                "WHERE table_name = 'stories'"
+            ))
+        }
+        if "last_part_at" not in columns:
+            conn.execute(text("ALTER TABLE stories ADD COLUMN last_part_at timestamp"))
+            conn.execute(text(
+                "UPDATE stories SET last_part_at = "
+                "(SELECT MAX(created_at) FROM parts WHERE parts.story_id = stories.id)"
+            ))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_stories_last_part_at "
+            "ON stories (last_part_at)"
+        ))
+        if "avg_rating" not in columns:
+            # cột sinh tự động giống khai báo Computed trên model; PostgreSQL
+            # chỉ hỗ trợ dạng STORED (không có VIRTUAL như SQLite)
+            conn.execute(text(
+                "ALTER TABLE stories ADD COLUMN avg_rating float "
+                "GENERATED ALWAYS AS "
+                "(CAST(rating_sum AS float) / NULLIF(rating_count, 0)) STORED"
+            ))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_stories_avg_rating "
+            "ON stories (is_hidden, avg_rating)"
+        ))
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS unaccent"))
+        conn.execute(text(
+            "CREATE OR REPLACE FUNCTION f_unaccent(text) RETURNS text AS "
+            "$$ SELECT unaccent('unaccent', $1) $$ LANGUAGE sql IMMUTABLE"
+        ))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_parts_content_fts ON parts "
+            "USING gin (to_tsvector('simple', f_unaccent(coalesce(content, ''))))"
+        ))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_stories_title_author_fts ON stories "
+            "USING gin (to_tsvector('simple', f_unaccent(coalesce(title, '') || ' ' || coalesce(author, ''))))"
+        ))
+        # index B-tree với varchar_pattern_ops để LIKE 'tiền-tố%' trong
+        # search() đi qua index (index lower() thường chỉ phục vụ so sánh =
+        # khi CSDL dùng collation khác C)
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_stories_lower_title_pattern "
+            "ON stories (lower(title) varchar_pattern_ops)"
+        ))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_stories_lower_author_pattern "
+            "ON stories (lower(author) varchar_pattern_ops)"
+        ))
+        # index một phần cho trang danh sách theo loại (xem __table_args__)
+        conn.execute(text("DROP INDEX IF EXISTS ix_stories_type_hidden_created"))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_stories_type_created_visible "
+            "ON stories (story_type, created_at DESC) WHERE is_hidden = false"
+        ))
+
+
+def init_db() -> None:
+    """Tạo bảng và nâng cấp lược đồ trong một app context."""
+    with app.app_context():
+        db.create_all()
+        # Nâng cấp cột chỉ chạy trên SQLite; với PostgreSQL chỉ bổ sung các
+        # index GIN tìm kiếm (thay đổi cột vẫn cần migration, ví dụ Alembic).
+        if db.engine.dialect.name == "sqlite":
+            upgrade_db()
+        elif db.engine.dialect.name == "postgresql":
+            upgrade_db_postgres()
+
+
+# Tinh chỉnh SQLite cho đường đi ghi/đọc nóng (tăng lượt xem, bình luận,
+# upload). Chế độ journal mặc định (DELETE) fsync và ghi lại journal ở mỗi
+# commit; WAL cho phép đọc song song với ghi và giảm một nửa số fsync.
+# mmap_size bỏ syscall read() trên đường đọc, cache_size giữ các trang nóng
+# trong bộ nhớ, temp_store=MEMORY tránh ghi file tạm khi sắp xếp.
 with app.app_context():
-    db.create_all()
-    # Chỉ thực hiện nâng cấp cột nếu đang sử dụng SQLite. Đối với PostgreSQL hoặc
-    # các hệ quản trị khác, cần dùng migration (ví dụ Alembic) để thay đổi lược đồ.
     if db.engine.dialect.name == "sqlite":
-        def upgrade_db():
-            """
-            Kiểm tra và thêm các cột mới vào bảng stories nếu chúng chưa tồn tại.
+        @event.listens_for(db.engine, "connect")
+        def _set_sqlite_pragmas(dbapi_conn, _connection_record):
+            cur = dbapi_conn.cursor()
+            cur.execute("PRAGMA journal_mode=WAL")
+            cur.execute("PRAGMA synchronous=NORMAL")
+            cur.execute("PRAGMA cache_size=-65536")       # ~64 MB cache trang
+            cur.execute("PRAGMA mmap_size=268435456")     # 256 MB mmap
+            cur.execute("PRAGMA temp_store=MEMORY")
+            cur.close()
+
+
+# Với SQLite local (không đặt DATABASE_URL), tự động khởi tạo khi import để
+# giữ trải nghiệm "chạy là được" khi phát triển. Khi triển khai với
+# DATABASE_URL (nhiều worker Gunicorn), việc create_all + kiểm tra lược đồ ở
+# mỗi worker chỉ tốn round-trip vô ích; chạy một lần qua `flask init-db`
+# hoặc đặt RUN_DB_INIT=1 nếu muốn giữ hành vi cũ.
+if not db_url or os.environ.get("RUN_DB_INIT") == "1":
+    init_db()
+
+# Làm nóng pool kết nối lúc worker khởi động: một câu SELECT 1 mở sẵn kết
+# nối đầu tiên nên request đầu (nhất là cache miss) không phải trả thêm phí
+# bắt tay TCP/TLS tới PostgreSQL. Nếu DB chưa sẵn sàng thì bỏ qua — pool sẽ
+# tự kết nối lại ở request đầu tiên nhờ pool_pre_ping.
+if db_url:
+    with app.app_context():
+        try:
+            db.session.execute(text("SELECT 1"))
+            db.session.rollback()
+        except Exception:
+            pass
 
-            Khi cập nhật phiên bản mới, cơ sở dữ liệu cũ sẽ thiếu các cột như
-            `is_hidden`, `rating_sum`, `rating_count` và `is_completed`. Hàm này
-            sử dụng PRAGMA để kiểm tra thông tin bảng và thực hiện ALTER TABLE
-            nếu cần. Lưu ý: Chỉ áp dụng cho SQLite.
-            """
-            with db.engine.connect() as conn:
-                result = conn.execute(text("PRAGMA table_info(stories)")).fetchall()
-                columns = [row[1] for row in result]
-                if "is_hidden" not in columns:
-                    conn.execute(text("ALTER TABLE stories ADD COLUMN is_hidden BOOLEAN DEFAULT 0"))
-                if "rating_sum" not in columns:
-                    conn.execute(text("ALTER TABLE stories ADD COLUMN rating_sum INTEGER DEFAULT 0"))
-                if "rating_count" not in columns:
-                    conn.execute(text("ALTER TABLE stories ADD COLUMN rating_count INTEGER DEFAULT 0"))
-                if "is_completed" not in columns:
-                    conn.execute(text("ALTER TABLE stories ADD COLUMN is_completed BOOLEAN DEFAULT 0"))
-
-        # gọi hàm nâng cấp sau khi tạo bảng
-        upgrade_db()
+
+@app.cli.command("init-db")
+def init_db_command() -> None:
+    """Lệnh CLI `flask init-db`: tạo bảng và nâng cấp lược đồ một lần."""
+    init_db()
+    print("Đã khởi tạo cơ sở dữ liệu.")
 
 
 def create_tables() -> None:
@@ -354,9 +714,270 @@ def create_tables() -> None:
         db.create_all()
 
 
+def story_list_options() -> tuple:
+    """Trả về các tuỳ chọn eager-load dùng chung cho truy vấn danh sách truyện.
+
+    Các template danh sách truy cập ``story.parts`` cho từng truyện, nên nếu để
+    lazy-load mặc định thì mỗi truyện sẽ phát sinh thêm truy vấn riêng (vấn đề
+    N+1). Dùng ``selectinload`` để nạp trước quan hệ này bằng một truy vấn
+    ``IN (...)`` cho cả trang. Quan hệ ``categories`` đã là ``lazy="selectin"``
+    ngay trong khai báo model nên không cần lặp lại ở đây.
+
+    Khi bật cờ ``RAISELOAD_CHECK`` (môi trường dev/staging), thêm
+    ``raiseload("*")`` làm lưới an toàn: quan hệ nào template truy cập mà chưa
+    được liệt kê rõ ở đây sẽ raise ngay, buộc phải khai báo eager-load tường
+    minh thay vì lọt thành N+1 lặng lẽ. Lúc đó ``categories`` phải được nêu
+    rõ vì ``raiseload("*")`` ghi đè cả ``lazy="selectin"`` mặc định của model.
+    """
+    if app.config.get("RAISELOAD_CHECK"):
+        return (
+            selectinload(Story.parts),
+            selectinload(Story.categories),
+            raiseload("*"),
+        )
+    return (
+        selectinload(Story.parts),
+    )
+
+
+class SimplePagination:
+    """Phân trang không cần truy vấn COUNT.
+
+    ``paginate()`` của Flask-SQLAlchemy chạy thêm một câu ``SELECT COUNT(*)``
+    trên toàn bộ truy vấn cho mỗi trang. Với các danh sách chỉ cần nút
+    "trang trước/trang sau" (như trang chủ), chỉ cần lấy ``per_page + 1``
+    dòng: dòng dư cho biết còn trang kế tiếp hay không, khỏi cần đếm tổng.
+    """
+
+    def __init__(self, items: list, page: int, per_page: int, has_next: bool) -> None:
+        self.items = items
+        self.page = page
+        self.per_page = per_page
+        self.has_next = has_next
+
+    @property
+    def has_prev(self) -> bool:
+        return self.page > 1
+
+    @property
+    def prev_num(self) -> int | None:
+        return self.page - 1 if self.has_prev else None
+
+    @property
+    def next_num(self) -> int | None:
+        return self.page + 1 if self.has_next else None
+
+
+def paginate_without_count(query, page: int, per_page: int) -> SimplePagination:
+    """Phân trang một truy vấn bằng LIMIT/OFFSET, bỏ hẳn câu COUNT."""
+    if page < 1:
+        page = 1
+    items = query.offset((page - 1) * per_page).limit(per_page + 1).all()
+    has_next = len(items) > per_page
+    return SimplePagination(items[:per_page], page, per_page, has_next)
+
+
+def delete_story_children(story_id: int) -> None:
+    """Xoá video, chương và bình luận của một truyện bằng ba câu DELETE.
+
+    Trước đây phần video bị xoá theo từng chương (một truy vấn mỗi chương —
+    mẫu N+1) hoặc bị bỏ sót thành dòng mồ côi. Dùng DELETE với subquery nên
+    mỗi bảng chỉ tốn một round-trip thay vì O(số chương).
+
+    Dùng ``synchronize_session="fetch"`` để các đối tượng Part/Comment đã nạp
+    trong session (ví dụ qua quan hệ ``story.parts``) được gỡ ra đúng cách;
+    nếu không, lệnh ``db.session.delete(story)`` tiếp theo sẽ cố UPDATE các
+    dòng con đã xoá và gây StaleDataError.
+    """
+    part_ids = select(Part.id).where(Part.story_id == story_id).scalar_subquery()
+    PartVideo.query.filter(PartVideo.part_id.in_(part_ids)).delete(
+        synchronize_session="fetch"
+    )
+    Part.query.filter_by(story_id=story_id).delete(synchronize_session="fetch")
+    Comment.query.filter_by(story_id=story_id).delete(synchronize_session="fetch")
+
+
+def build_snippet(
+    content: str,
+    match_re: "re.Pattern[str]",
+    highlight_re: "re.Pattern[str]",
+    window: int = 50,
+) -> str:
+    """Cắt đoạn trích quanh vị trí khớp đầu tiên và tô sáng các từ khoá.
+
+    Dùng regex đã biên dịch để tìm vị trí khớp (quét ở tầng C, không phân biệt
+    hoa/thường) thay vì tạo bản sao ``content.lower()`` của cả chương — với
+    chương dài hàng megabyte, bản sao đó từng là phần tốn CPU/bộ nhớ nhất của
+    trang tìm kiếm. Chỉ đoạn trích ngắn quanh vị trí khớp mới được xử lý tiếp.
+    """
+    # thử nguyên cụm trước, không thấy thì lùi về từng từ khoá riêng lẻ
+    m = match_re.search(content) or highlight_re.search(content)
+    if m:
+        idx, match_len = m.start(), m.end() - m.start()
+    else:
+        idx, match_len = 0, 0
+    start = max(0, idx - window)
+    end = min(len(content), idx + match_len + window)
+    snippet = content[start:end]
+    return highlight_re.sub(
+        lambda mm: f'<span class="highlight">{mm.group(0)}</span>', snippet
+    )
+
+
+def check_upload_password(password: str) -> bool:
+    """Kiểm tra mật khẩu upload bằng so sánh thời-gian-không-đổi.
+
+    ``==`` trên chuỗi thoát sớm ở byte khác đầu tiên nên kẻ dò mật khẩu có
+    thể đo thời gian phản hồi để đoán dần từng ký tự. ``hmac.compare_digest``
+    luôn duyệt hết chuỗi nên thời gian không phụ thuộc vị trí sai. Cookie
+    session đánh dấu ``upload_authenticated`` vốn đã được Flask ký bằng
+    itsdangerous với SECRET_KEY nên không cần thay đổi gì thêm ở phía đó.
+    """
+    return hmac.compare_digest((password or "").encode(), UPLOAD_PASSWORD)
+
+
+def add_part_videos(part_id: int, video_urls: list[str]) -> None:
+    """Lưu danh sách liên kết video cho một phần bằng một câu INSERT duy nhất.
+
+    Chỉ lấy tối đa 9 liên kết (bỏ liên kết rỗng) để tránh quá nhiều mục.
+    Dùng executemany qua ``db.insert`` thay vì ``session.add`` từng dòng để
+    không phải flush từng INSERT riêng lẻ.
+    """
+    rows = [
+        {"part_id": part_id, "url": url}
+        for url in ((u or "").strip() for u in video_urls[:9])
+        if url
+    ]
+    if rows:
+        db.session.execute(db.insert(PartVideo), rows)
+
+
+def get_part_previews(story_id: int):
+    """Lấy danh sách chương của truyện kèm 200 ký tự nội dung đầu tiên.
+
+    Trang quản trị chỉ hiển thị đoạn trích ngắn của mỗi chương, nên cắt nội
+    dung ngay trong SQL bằng substr thay vì tải toàn bộ cột TEXT về Python.
+    """
+    return db.session.execute(
+        select(
+            Part.id,
+            Part.part_number,
+            func.substr(Part.content, 1, 200).label("content"),
+            Part.created_at,
+        )
+        .where(Part.story_id == story_id)
+        .order_by(Part.part_number)
+    ).all()
+
+
+# ------------------ Cached home-page aggregates ------------------
+
+@cache.cached(timeout=60, key_prefix="home:trending")
+def get_trending_stories() -> list[Story]:
+    """Trả về tối đa 20 truyện có lượt xem cao nhất (không gồm truyện ẩn)."""
+    return (
+        Story.query.options(*story_list_options())
+        .filter_by(is_hidden=False)
+        .order_by(Story.views.desc())
+        .limit(20)
+        .all()
+    )
+
+
+@cache.cached(timeout=60, key_prefix="home:best")
+def get_best_stories() -> list[Story]:
+    """Trả về tối đa 10 truyện có điểm đánh giá trung bình cao nhất."""
+    return (
+        Story.query.options(*story_list_options())
+        .filter(Story.rating_count > 0, Story.is_hidden == False)
+        .order_by(Story.avg_rating.desc())
+        .limit(10)
+        .all()
+    )
+
+
+@cache.cached(timeout=60, key_prefix="home:recent")
+def get_recent_stories() -> list[Story]:
+    """Trả về tối đa 10 truyện có chương được thêm mới nhất.
+
+    Sắp theo cột denormalize ``Story.last_part_at`` (có index) nên không còn
+    phải GROUP BY + JOIN qua bảng parts ở mỗi lần làm mới cache.
+    """
+    return (
+        Story.query.options(*story_list_options())
+        .filter(Story.is_hidden == False, Story.last_part_at.isnot(None))
+        .order_by(Story.last_part_at.desc())
+        .limit(10)
+        .all()
+    )
+
+
+@cache.memoize(timeout=60)
+def count_admin_stories(q: str, stype: str) -> int:
+    """Đếm tổng số truyện khớp bộ lọc của trang quản trị (cache 60 giây).
+
+    Câu COUNT trên truy vấn tìm theo nội dung (JOIN parts + DISTINCT) phải
+    materialize toàn bộ phép join ở mỗi trang; cache kết quả theo (q, stype)
+    để chỉ đếm lại mỗi phút thay vì mỗi lần chuyển trang.
+    """
+    query = Story.query
+    if q:
+        pattern = f"%{q}%"
+        if stype == "content":
+            query = Story.query.join(Part).filter(Part.content.ilike(pattern)).distinct()
+        else:
+            query = query.filter(
+                (Story.title.ilike(pattern)) | (Story.author.ilike(pattern))
+            )
+    return query.count()
+
+
+@cache.memoize(timeout=60)
+def count_type_stories(story_type: str) -> int:
+    """Đếm số truyện hiển thị của một loại ngắn/dài (cache 60 giây).
+
+    Trang danh sách theo loại chỉ cần tổng này để tính nút "trang cuối";
+    cache lại để mỗi lượt chuyển trang không phải chạy thêm một câu COUNT
+    quét cả bảng.
+    """
+    return Story.query.filter_by(story_type=story_type, is_hidden=False).count()
+
+
+def has_pending_flash() -> bool:
+    """Bỏ qua cache nguyên trang khi session có flash message đang chờ.
+
+    layout.html render ``get_flashed_messages()`` ngay trong trang, nên nếu
+    cache một lượt xem có flash thì thông báo riêng của người đó bị nướng vào
+    HTML dùng chung và phát cho mọi khách trong suốt TTL. Người có flash được
+    render tươi (tự tiêu thụ thông báo của mình), không đọc/ghi cache.
+    """
+    return bool(session.get("_flashes"))
+
+
+def page_cache_key() -> str:
+    """Khoá cache trang HTML đầy đủ cho các trang danh sách công khai.
+
+    Khoá gồm số phiên bản + đường dẫn kèm query string. Khi dữ liệu truyện
+    thay đổi, chỉ cần tăng số phiên bản là mọi trang đã cache đều bị bỏ qua
+    (không cần liệt kê từng tổ hợp trang/tham số); bản cũ tự hết hạn theo TTL.
+    """
+    ver = cache.get("pages:ver") or 0
+    return f"page:{ver}:{request.full_path}"
+
+
+def invalidate_home_cache() -> None:
+    """Xoá cache các khối tổng hợp của trang chủ sau khi dữ liệu truyện thay đổi."""
+    cache.delete_many("home:trending", "home:best", "home:recent")
+    # tổng số truyện của trang quản trị cũng đổi theo nên xoá luôn cache đếm
+    cache.delete_memoized(count_admin_stories)
+    cache.delete_memoized(count_type_stories)
+    # tăng phiên bản để vô hiệu các trang danh sách đã cache nguyên trang
+    cache.set("pages:ver", (cache.get("pages:ver") or 0) + 1)
+
+
 # ------------------ Comment handling and notification ------------------
 
-def send_comment_notification(recipients: list[str], story: Story, comment_url: str) -> bool:
+def send_comment_notification(recipients: list[str], story_title: str, comment_url: str) -> bool:
     """Gửi email thông báo tới danh sách người nhận khi có bình luận mới.
 
     Trả về True nếu gửi thành công, False nếu không gửi được. Hàm sẽ đọc các
@@ -385,12 +1006,12 @@ def send_comment_notification(recipients: list[str], story: Story, comment_url:
     from_name = os.environ.get("EMAIL_FROM_NAME", "Webdoctruyen Admin")
     from_addr = os.environ.get("EMAIL_FROM_ADDR", "admin@webdoctruyen.org")
     # Tạo nội dung email
-    subject = f"Có bình luận mới cho truyện '{story.title}'"
+    subject = f"Có bình luận mới cho truyện '{story_title}'"
     body = (
         "Xin chào,\n\n"
         "Có người vừa bình luận một truyện mà bạn đã theo dõi. "
         f"Bạn có thể xem bình luận và trả lời tại: {comment_url}\n\n"
-        f"Truyện: {story.title}\n"
+        f"Truyện: {story_title}\n"
         "Cảm ơn bạn đã quan tâm tới webdoctruyen.org."
     )
     msg = EmailMessage()
@@ -408,6 +1029,25 @@ def send_comment_notification(recipients: list[str], story: Story, comment_url:
         return False
 
 
+def send_comment_notification_async(
+    recipients: list[str], story_title: str, comment_url: str
+) -> None:
+    """Gửi email thông báo trong một thread nền.
+
+    Kết nối SMTP (DNS + TLS handshake + gửi) có thể mất vài giây; nếu gửi
+    đồng bộ thì request POST bình luận phải chờ mạng xong mới trả lời người
+    dùng. Thread daemon tách việc gửi ra khỏi đường đi request; chỉ truyền
+    các giá trị thuần (chuỗi) nên không đụng tới session/ORM ngoài request.
+    """
+    if not recipients:
+        return
+    threading.Thread(
+        target=send_comment_notification,
+        args=(recipients, story_title, comment_url),
+        daemon=True,
+    ).start()
+
+
 @app.route("/comment/<int:story_id>", methods=["POST"])
 def post_comment(story_id: int):
     """Xử lý việc đăng bình luận cho một truyện.
@@ -418,7 +1058,7 @@ def post_comment(story_id: int):
     luận). Sau khi xử lý xong, chuyển hướng về lại trang mà người dùng
     bình luận. Thông báo lỗi sẽ được flash nếu nội dung rỗng.
     """
-    story = Story.query.get_or_404(story_id)
+    story = db.get_or_404(Story, story_id)
     name = request.form.get("name", "").strip()
     # không sử dụng email trong phiên bản này
     content = request.form.get("content", "").strip()
@@ -459,45 +1099,27 @@ def index():
     per_page = 10
     # truyện ngắn (không bao gồm truyện ẩn)
     short_query = (
-        Story.query.filter_by(story_type="short", is_hidden=False)
+        Story.query.options(*story_list_options())
+        .filter_by(story_type="short", is_hidden=False)
         .order_by(Story.created_at.desc())
     )
-    short_pagination = short_query.paginate(page=short_page, per_page=per_page, error_out=False)
+    # trang chủ chỉ cần nút trước/sau nên dùng phân trang không COUNT
+    short_pagination = paginate_without_count(short_query, short_page, per_page)
     short_stories = short_pagination.items
     # truyện dài (không bao gồm truyện ẩn)
     long_query = (
-        Story.query.filter_by(story_type="long", is_hidden=False)
+        Story.query.options(*story_list_options())
+        .filter_by(story_type="long", is_hidden=False)
         .order_by(Story.created_at.desc())
     )
-    long_pagination = long_query.paginate(page=long_page, per_page=per_page, error_out=False)
+    long_pagination = paginate_without_count(long_query, long_page, per_page)
     long_stories = long_pagination.items
-    # truyện nhiều người đọc nhất: giới hạn 20 theo lượt xem, không bao gồm truyện ẩn
-    trending = (
-        Story.query.filter_by(is_hidden=False).order_by(Story.views.desc()).limit(20).all()
-    )
-
-    # truyện hay nhất: sắp xếp theo trung bình đánh giá (rating_sum / rating_count)
-    # chỉ lấy những truyện đã có ít nhất 1 lượt đánh giá
-    best = (
-        Story.query.filter(Story.rating_count > 0, Story.is_hidden == False)
-        .order_by((Story.rating_sum / Story.rating_count).desc())
-        .limit(10)
-        .all()
-    )
-    # Lấy danh sách truyện có chương được thêm mới nhất (truyện mới cập nhật)
-    # Sử dụng subquery để lấy thời gian tạo phần mới nhất cho mỗi truyện
-    recent_parts = (
-        db.session.query(Part.story_id, db.func.max(Part.created_at).label("latest_part"))
-        .group_by(Part.story_id)
-        .subquery()
-    )
-    recent_stories = (
-        Story.query.join(recent_parts, Story.id == recent_parts.c.story_id)
-        .filter(Story.is_hidden == False)
-        .order_by(recent_parts.c.latest_part.desc())
-        .limit(10)
-        .all()
-    )
+    # Các khối tổng hợp (nổi bật, hay nhất, mới cập nhật) được cache 60 giây
+    # trong các helper get_*_stories() để không phải chạy lại các truy vấn
+    # tổng hợp ở mỗi lượt xem trang chủ.
+    trending = get_trending_stories()
+    best = get_best_stories()
+    recent_stories = get_recent_stories()
     # danh sách thể loại để hiển thị trong thanh bên
     categories = get_sorted_categories()
     return render_template(
@@ -521,12 +1143,23 @@ def story_detail(story_id: int):
     - Hỗ trợ hiển thị theo từng phần (chương). Nếu truyện có nhiều hơn một phần,
       người đọc có thể chuyển tới phần trước/tiếp theo hoặc chọn phần cụ thể.
     """
-    story = Story.query.get_or_404(story_id)
-    # tăng lượt xem
-    story.views = (story.views or 0) + 1
+    story = db.get_or_404(Story, story_id)
+    # tăng lượt xem bằng một câu UPDATE nguyên tử ngay trong CSDL.
+    # Cách này tránh đọc-sửa-ghi qua đối tượng ORM (dễ mất lượt đếm khi nhiều
+    # request cùng xem một truyện) và chỉ tốn một round-trip thay vì hai.
+    Story.query.filter_by(id=story.id).update(
+        {Story.views: func.coalesce(Story.views, 0) + 1},
+        synchronize_session=False,
+    )
     db.session.commit()
-    # Lấy danh sách tất cả các phần của truyện (sắp xếp theo số thứ tự)
-    parts = Part.query.filter_by(story_id=story.id).order_by(Part.part_number).all()
+    # Danh sách chương chỉ cần số thứ tự và dòng tiêu đề (dòng đầu của nội
+    # dung) để dựng mục lục, nên chỉ tải 200 ký tự đầu mỗi chương thay vì kéo
+    # toàn bộ nội dung của mọi chương vào bộ nhớ chỉ để chọn ra một chương.
+    parts = db.session.execute(
+        select(Part.part_number, func.substr(Part.content, 1, 200).label("content"))
+        .where(Part.story_id == story.id)
+        .order_by(Part.part_number)
+    ).all()
     total_parts = len(parts)
     # Xác định phần đang chọn từ query string (part=)
     part_param = request.args.get("part", default=None, type=int)
@@ -535,15 +1168,18 @@ def story_detail(story_id: int):
         current_index = part_param
     else:
         current_index = 1
-    # Phần hiện tại cần hiển thị
-    current_part = None
-    if parts:
-        for p in parts:
-            if p.part_number == current_index:
-                current_part = p
-                break
+    # Chỉ phần đang đọc mới cần nội dung đầy đủ (kèm danh sách video)
+    current_part = db.session.execute(
+        select(Part)
+        .options(selectinload(Part.videos))
+        .where(Part.story_id == story.id, Part.part_number == current_index)
+    ).scalars().first()
     # Lấy danh sách bình luận cho truyện (mới nhất lên đầu)
-    comments = Comment.query.filter_by(story_id=story.id).order_by(Comment.created_at.desc()).all()
+    comments = db.session.execute(
+        select(Comment)
+        .where(Comment.story_id == story.id)
+        .order_by(Comment.created_at.desc())
+    ).scalars().all()
     # url hiện tại (bao gồm query string) để gắn vào form comment
     current_url = request.url
     return render_template(
@@ -573,9 +1209,6 @@ def upload():
     if not session.get("upload_authenticated"):
         return redirect(url_for("upload_login"))
 
-    # Mật khẩu upload; bạn có thể thay đổi hằng số này theo nhu cầu
-    UPLOAD_PASSWORD = os.environ.get("UPLOAD_PASSWORD", "secret")
-
     # Danh sách thể loại luôn cần cho các form
     categories = get_sorted_categories()
     # Xử lý tham số tìm kiếm và phân trang cho danh sách truyện
@@ -584,7 +1217,9 @@ def upload():
     search_query = request.args.get("q", "").strip()
     search_type = request.args.get("stype", "title")
 
-    stories_query = Story.query.order_by(Story.created_at.desc())
+    stories_query = (
+        Story.query.options(*story_list_options()).order_by(Story.created_at.desc())
+    )
     # Bộ sưu tập snippet highlight khi tìm theo nội dung
     highlight_snippets: dict[int, str] = {}
 
@@ -593,7 +1228,8 @@ def upload():
         if search_type == "content":
             # tìm theo nội dung chương: join tới bảng Part
             stories_query = (
-                Story.query.join(Part)
+                Story.query.options(*story_list_options())
+                .join(Part)
                 .filter(Part.content.ilike(pattern))
                 .distinct()
                 .order_by(Story.created_at.desc())
@@ -603,63 +1239,81 @@ def upload():
             stories_query = stories_query.filter(
                 (Story.title.ilike(pattern)) | (Story.author.ilike(pattern))
             )
-    # Phân trang 25 truyện một trang
-    stories_pagination = stories_query.paginate(page=page, per_page=25, error_out=False)
+    # Phân trang 25 truyện một trang. Bỏ câu COUNT mặc định của paginate()
+    # (đắt nhất với tìm theo nội dung: JOIN + DISTINCT) và gán tổng số từ
+    # helper được cache theo (q, stype).
+    stories_pagination = stories_query.paginate(
+        page=page, per_page=25, error_out=False, count=False
+    )
+    stories_pagination.total = count_admin_stories(search_query, search_type)
     stories = stories_pagination.items
 
     # Nếu tìm theo nội dung, tạo đoạn trích có highlight cho từng truyện trong trang
     if search_query and search_type == "content":
         # Tách từ khoá để highlight riêng từng từ (có thể nhiều từ)
         keywords = [kw.lower() for kw in search_query.split() if kw.strip()]
+        # Gộp tất cả từ khoá vào một mẫu regex biên dịch sẵn: mỗi đoạn trích
+        # chỉ cần một lượt sub thay vì một lượt cho từng từ khoá.
+        highlight_re = (
+            re.compile("|".join(re.escape(kw) for kw in keywords), re.IGNORECASE)
+            if keywords
+            else None
+        )
+        # Lấy chương khớp đầu tiên của mọi truyện trong trang bằng MỘT truy vấn
+        # dùng window function, thay vì một truy vấn ILIKE riêng cho từng truyện
+        # (mẫu N+1). row_number() đánh số các chương khớp theo part_number trong
+        # từng truyện; chỉ giữ lại dòng số 1 của mỗi truyện.
+        story_ids = [st.id for st in stories]
+        match_by_story: dict[int, str] = {}
+        if story_ids:
+            rn = (
+                func.row_number()
+                .over(partition_by=Part.story_id, order_by=Part.part_number)
+                .label("rn")
+            )
+            matched_parts = (
+                db.session.query(Part.story_id, Part.content, rn)
+                .filter(Part.story_id.in_(story_ids), Part.content.ilike(pattern))
+                .subquery()
+            )
+            first_matches = (
+                db.session.query(matched_parts.c.story_id, matched_parts.c.content)
+                .filter(matched_parts.c.rn == 1)
+                .all()
+            )
+            match_by_story = {sid: content for sid, content in first_matches}
+        # Mẫu tìm vị trí trích: ưu tiên nguyên cụm từ khoá, nếu không khớp thì
+        # highlight_re (từng từ riêng lẻ) trong build_snippet vẫn tô sáng đúng.
+        match_re = re.compile(re.escape(search_query), re.IGNORECASE)
         for st in stories:
-            # tìm chương đầu tiên chứa từ khoá
-            part_match = (
-                Part.query.filter(
-                    Part.story_id == st.id,
-                    Part.content.ilike(pattern),
+            # chương đầu tiên chứa từ khoá (đã lấy sẵn ở trên)
+            matched_content = match_by_story.get(st.id)
+            if matched_content and highlight_re is not None:
+                highlight_snippets[st.id] = build_snippet(
+                    matched_content, match_re, highlight_re
                 )
-                .order_by(Part.part_number)
-                .first()
-            )
-            if part_match:
-                content_lower = part_match.content.lower()
-                idx = content_lower.find(search_query.lower())
-                if idx < 0:
-                    # nếu không tìm thấy nguyên chuỗi, thử tìm theo từ đầu tiên
-                    idx = content_lower.find(keywords[0]) if keywords else 0
-                start = max(0, idx - 50)
-                end = min(len(part_match.content), idx + len(search_query) + 50)
-                snippet = part_match.content[start:end]
-                # highlight tất cả từ khoá
-                def repl(m: re.Match) -> str:
-                    return f'<span class="highlight">{m.group(0)}</span>'
-                for kw in keywords:
-                    snippet = re.sub(
-                        rf"({re.escape(kw)})",
-                        repl,
-                        snippet,
-                        flags=re.IGNORECASE,
-                    )
-                highlight_snippets[st.id] = snippet
 
     # Xử lý gửi form (POST)
     if request.method == "POST":
-        # kiểm tra mật khẩu
-        password = request.form.get("password", "")
-        if password != UPLOAD_PASSWORD:
+        # Đọc MultiDict của form một lần; các nhánh bên dưới tra cứu hơn chục
+        # trường nên dùng biến cục bộ thay vì đi qua proxy request mỗi lần.
+        form = request.form
+        # kiểm tra mật khẩu (so sánh thời-gian-không-đổi)
+        password = form.get("password", "")
+        if not check_upload_password(password):
             # giữ nguyên giao diện, thông báo lỗi
-            story_id = request.form.get("existing_story_id")
+            story_id = form.get("existing_story_id")
             if story_id:
                 # nếu đang chỉnh sửa, tải lại trang edit
-                story = Story.query.get(int(story_id))
-                parts = Part.query.filter_by(story_id=story.id).order_by(Part.part_number).all()
+                story = db.session.get(Story, int(story_id))
+                parts = get_part_previews(story.id)
                 # nếu đang cập nhật một phần cụ thể, lấy lại thông tin phần đó để hiển thị
-                edit_part_id_form = request.form.get("part_id")
+                edit_part_id_form = form.get("part_id")
                 edit_part_obj = None
                 if edit_part_id_form:
                     try:
                         pid_int = int(edit_part_id_form)
-                        edit_part_obj = Part.query.get(pid_int)
+                        edit_part_obj = db.session.get(Part, pid_int)
                     except Exception:
                         edit_part_obj = None
                 return render_template(
@@ -684,20 +1338,20 @@ def upload():
                 )
 
         # Nếu có existing_story_id thì là thao tác trên truyện đã có
-        existing_story_id = request.form.get("existing_story_id")
-        action = request.form.get("action")
+        existing_story_id = form.get("existing_story_id")
+        action = form.get("action")
         if existing_story_id:
-            story = Story.query.get_or_404(int(existing_story_id))
+            story = db.get_or_404(Story, int(existing_story_id))
             if action == "update_story":
                 # cập nhật thông tin truyện
-                story.title = request.form.get("title", "").strip()
-                story.author = request.form.get("author", "").strip()
-                story_type = request.form.get("story_type", "short")
+                story.title = form.get("title", "").strip()
+                story.author = form.get("author", "").strip()
+                story_type = form.get("story_type", "short")
                 story.story_type = story_type
                 # đánh dấu truyện hoàn thành hay chưa
-                story.is_completed = True if request.form.get("is_completed") else False
+                story.is_completed = True if form.get("is_completed") else False
                 # danh sách thể loại được chọn (có thể nhiều)
-                cat_ids = request.form.getlist("category_ids")
+                cat_ids = form.getlist("category_ids")
                 # chuyển thành list int
                 cat_ids_int = [int(cid) for cid in cat_ids if cid]
                 # gán quan hệ nhiều‑nhiều
@@ -710,12 +1364,13 @@ def upload():
                 # đặt category_id bằng thể loại đầu tiên (nếu có) để đảm bảo tương thích
                 story.category_id = cat_ids_int[0] if cat_ids_int else None
                 db.session.commit()
+                invalidate_home_cache()
                 return redirect(url_for("upload", story_id=story.id))
             elif action == "add_part":
                 # thêm phần mới cho truyện
-                content = request.form.get("content", "").rstrip()
+                content = form.get("content", "").rstrip()
                 if not content:
-                    parts = Part.query.filter_by(story_id=story.id).order_by(Part.part_number).all()
+                    parts = get_part_previews(story.id)
                     return render_template(
                         "upload_edit.html",
                         error="Nội dung phần mới không được trống.",
@@ -739,50 +1394,61 @@ def upload():
                 next_number = last_part.part_number + 1 if last_part else 1
                 new_part = Part(story_id=story.id, part_number=next_number, content=content)
                 db.session.add(new_part)
+                # cập nhật mốc chương mới nhất cho danh sách "mới cập nhật"
+                story.last_part_at = datetime.utcnow()
                 db.session.commit()
-                # Lưu các liên kết video cho phần mới
-                video_urls = request.form.getlist("video_urls")
-                # Chỉ lấy tối đa 9 liên kết video để tránh quá nhiều mục
-                for url in video_urls[:9]:
-                    url = (url or "").strip()
-                    if url:
-                        db.session.add(PartVideo(part_id=new_part.id, url=url))
+                # Lưu các liên kết video cho phần mới trong một câu INSERT
+                add_part_videos(new_part.id, form.getlist("video_urls"))
                 db.session.commit()
+                invalidate_home_cache()
                 return redirect(url_for("upload", story_id=story.id))
             elif action == "delete_last":
                 # xoá phần cuối cùng nếu có
                 last_part = Part.query.filter_by(story_id=story.id).order_by(Part.part_number.desc()).first()
                 if last_part:
                     db.session.delete(last_part)
+                    # tính lại mốc chương mới nhất từ các chương còn lại
+                    story.last_part_at = (
+                        db.session.query(func.max(Part.created_at))
+                        .filter(Part.story_id == story.id, Part.id != last_part.id)
+                        .scalar()
+                    )
                     db.session.commit()
+                    invalidate_home_cache()
                 return redirect(url_for("upload", story_id=story.id))
             elif action == "toggle_hidden":
                 # ẩn hoặc hiện lại truyện
                 story.is_hidden = not (story.is_hidden or False)
                 db.session.commit()
+                invalidate_home_cache()
                 return redirect(url_for("upload", story_id=story.id))
             elif action == "delete_story":
                 # xoá hoàn toàn một truyện và các phần liên quan
                 # gỡ mối quan hệ với thể loại
                 story.categories = []
-                # xoá tất cả các chương của truyện
-                Part.query.filter_by(story_id=story.id).delete()
+                # xoá video, chương và bình luận của truyện (mỗi bảng một DELETE)
+                delete_story_children(story.id)
                 # xoá truyện
                 db.session.delete(story)
                 db.session.commit()
+                invalidate_home_cache()
                 return redirect(url_for("upload"))
             elif action == "replace_text":
                 # Thay thế cụm từ trong tất cả các chương của truyện
-                search_str = request.form.get("search_string", "").strip()
-                replacement = request.form.get("replacement_string", "")
+                search_str = form.get("search_string", "").strip()
+                replacement = form.get("replacement_string", "")
                 if not search_str:
                     flash("Bạn phải nhập cụm từ cần tìm.")
                     return redirect(url_for("upload", story_id=story.id))
                 parts = Part.query.filter_by(story_id=story.id).all()
                 replaced_count = 0
                 for part in parts:
-                    if search_str in part.content:
-                        part.content = part.content.replace(search_str, replacement)
+                    # replace() quét nội dung đúng một lần; CPython trả lại
+                    # chính chuỗi cũ khi không có gì để thay nên kiểm tra
+                    # identity phát hiện chương không đổi mà khỏi so sánh lại
+                    new_content = part.content.replace(search_str, replacement)
+                    if new_content is not part.content and new_content != part.content:
+                        part.content = new_content
                         replaced_count += 1
                 if replaced_count > 0:
                     db.session.commit()
@@ -792,14 +1458,14 @@ def upload():
                 return redirect(url_for("upload", story_id=story.id))
             elif action == "update_part":
                 # cập nhật nội dung của một chương cụ thể
-                part_id = request.form.get("part_id")
-                content = request.form.get("content", "").strip()
+                part_id = form.get("part_id")
+                content = form.get("content", "").strip()
                 # kiểm tra dữ liệu hợp lệ
                 if not part_id or not content:
-                    parts = Part.query.filter_by(story_id=story.id).order_by(Part.part_number).all()
+                    parts = get_part_previews(story.id)
                     edit_part_obj = None
                     try:
-                        edit_part_obj = Part.query.get(int(part_id))
+                        edit_part_obj = db.session.get(Part, int(part_id))
                     except Exception:
                         pass
                     return render_template(
@@ -811,33 +1477,35 @@ def upload():
                         error_update="Nội dung không được để trống.",
                     )
                 try:
-                    part_obj = Part.query.get(int(part_id))
+                    # lọc đồng thời theo id và story_id: CSDL tự kiểm tra chương
+                    # có thuộc truyện đang sửa không, khỏi so sánh lại ở Python
+                    part_obj = Part.query.filter_by(
+                        id=int(part_id), story_id=story.id
+                    ).first()
                 except Exception:
                     part_obj = None
-                if part_obj and part_obj.story_id == story.id:
+                if part_obj:
                     part_obj.content = content
                     # Cập nhật các liên kết video: xoá cũ và thêm mới
                     # Xoá toàn bộ video cũ của phần
-                    PartVideo.query.filter_by(part_id=part_obj.id).delete()
-                    video_urls = request.form.getlist("video_urls")
-                    for url in video_urls[:9]:
-                        url = (url or "").strip()
-                        if url:
-                            db.session.add(PartVideo(part_id=part_obj.id, url=url))
+                    PartVideo.query.filter_by(part_id=part_obj.id).delete(
+                        synchronize_session=False
+                    )
+                    add_part_videos(part_obj.id, form.getlist("video_urls"))
                     db.session.commit()
                 return redirect(url_for("upload", story_id=story.id))
             # không nhận ra action, trở lại trang edit
             return redirect(url_for("upload", story_id=story.id))
         else:
             # tạo truyện mới
-            title = request.form.get("title", "").strip()
-            author = request.form.get("author", "").strip()
-            story_type = request.form.get("story_type", "short")
+            title = form.get("title", "").strip()
+            author = form.get("author", "").strip()
+            story_type = form.get("story_type", "short")
             # trạng thái hoàn thành
-            is_completed = True if request.form.get("is_completed") else False
+            is_completed = True if form.get("is_completed") else False
             # nhận danh sách thể loại (có thể nhiều) từ form
-            cat_ids = request.form.getlist("category_ids")
-            content = request.form.get("content", "").strip()
+            cat_ids = form.getlist("category_ids")
+            content = form.get("content", "").strip()
             if not title or not content:
                 return render_template(
                     "upload_new.html",
@@ -869,26 +1537,24 @@ def upload():
             # tạo phần đầu tiên
             first_part = Part(story_id=story.id, part_number=1, content=content)
             db.session.add(first_part)
+            story.last_part_at = datetime.utcnow()
             db.session.commit()
             # Lưu các liên kết video cho chương đầu
-            video_urls = request.form.getlist("video_urls")
-            for url in video_urls[:9]:
-                url = (url or "").strip()
-                if url:
-                    db.session.add(PartVideo(part_id=first_part.id, url=url))
+            add_part_videos(first_part.id, form.getlist("video_urls"))
             db.session.commit()
+            invalidate_home_cache()
             return redirect(url_for("upload", story_id=story.id))
 
     # Xử lý GET: hiển thị trang mới hoặc trang chỉnh sửa
     story_id = request.args.get("story_id")
     if story_id:
-        story = Story.query.get_or_404(int(story_id))
-        parts = Part.query.filter_by(story_id=story.id).order_by(Part.part_number).all()
+        story = db.get_or_404(Story, int(story_id))
+        parts = get_part_previews(story.id)
         # Kiểm tra xem có tham số edit_part trên URL để hiển thị form cập nhật chương
         edit_part_id = request.args.get("edit_part", type=int)
         edit_part_obj = None
         if edit_part_id:
-            edit_part_obj = Part.query.get(edit_part_id)
+            edit_part_obj = db.session.get(Part, edit_part_id)
             # chỉ hiển thị nếu chương thuộc truyện đang chỉnh sửa
             if edit_part_obj and edit_part_obj.story_id != story.id:
                 edit_part_obj = None
@@ -924,11 +1590,9 @@ def upload_login():
     trong sidebar, giống như các trang khác.
     """
     categories = get_sorted_categories()
-    # Mật khẩu upload từ biến môi trường hoặc giá trị mặc định
-    UPLOAD_PASSWORD = os.environ.get("UPLOAD_PASSWORD", "secret")
     if request.method == "POST":
         password = request.form.get("password", "")
-        if password == UPLOAD_PASSWORD:
+        if check_upload_password(password):
             # Ghi nhớ rằng người dùng đã đăng nhập để tránh phải nhập lại trong phiên
             session["upload_authenticated"] = True
             return redirect(url_for("upload"))
@@ -955,72 +1619,100 @@ def export_data():
     """
     if not session.get("upload_authenticated"):
         return redirect(url_for("upload_login"))
-    UPLOAD_PASSWORD = os.environ.get("UPLOAD_PASSWORD", "secret")
-    pw = request.form.get("password", "")
-    if pw != UPLOAD_PASSWORD:
+    if not check_upload_password(request.form.get("password", "")):
         flash("Mật khẩu không hợp lệ.")
         return redirect(url_for("upload"))
-    stories = Story.query.all()
-    categories = Category.query.all()
-    parts = Part.query.all()
-    videos = PartVideo.query.all()
-    comments = Comment.query.all()
-    data = {
-        "categories": [
-            {"id": c.id, "name": c.name} for c in categories
-        ],
-        "stories": [
-            {
-                "id": s.id,
-                "title": s.title,
-                "author": s.author,
-                "story_type": s.story_type,
-                "created_at": s.created_at.isoformat() if s.created_at else None,
-                "views": s.views,
-                "is_hidden": s.is_hidden,
-                "is_completed": s.is_completed,
-                "rating_sum": s.rating_sum,
-                "rating_count": s.rating_count,
-                "category_id": s.category_id,
-                "categories": [cat.id for cat in s.categories],
-            }
-            for s in stories
-        ],
-        "parts": [
-            {
-                "id": p.id,
-                "story_id": p.story_id,
-                "part_number": p.part_number,
-                "content": p.content,
-                "created_at": p.created_at.isoformat() if p.created_at else None,
-            }
-            for p in parts
-        ],
-        "comments": [
-            {
-                "id": c.id,
-                "story_id": c.story_id,
-                "url": c.url,
-                "name": c.name,
-                "email": c.email,
-                "content": c.content,
-                "created_at": c.created_at.isoformat() if c.created_at else None,
-            }
-            for c in comments
-        ],
-        "videos": [
-            {
-                "id": v.id,
-                "part_id": v.part_id,
-                "url": v.url,
-            }
-            for v in videos
-        ],
-    }
-    json_bytes = json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
-    buf = io.BytesIO(json_bytes)
+    def generate():
+        """Sinh JSON export theo từng bản ghi thay vì dựng toàn bộ chuỗi trong RAM.
+
+        Mỗi bảng được stream bằng yield_per nên bộ nhớ đỉnh chỉ phụ thuộc vào
+        kích thước một lô bản ghi, không phải toàn bộ dữ liệu export.
+        """
+
+        def array(name, rows, last=False):
+            yield f'"{name}": ['.encode()
+            first = True
+            for row in rows:
+                # orjson mã hoá bằng C nhanh hơn json chuẩn nhiều lần và trả
+                # về bytes, ghi thẳng ra response không cần encode lại
+                yield (b"" if first else b",") + orjson.dumps(row)
+                first = False
+            yield b"]" + (b"" if last else b",")
+
+        yield b"{"
+        yield from array(
+            "categories",
+            ({"id": c.id, "name": c.name} for c in Category.query.yield_per(500)),
+        )
+        # selectinload tường minh: export duyệt s.categories cho mọi truyện nên
+        # nạp theo lô bằng truy vấn IN thay vì dựa vào lazy-load
+        yield from array(
+            "stories",
+            (
+                {
+                    "id": s.id,
+                    "title": s.title,
+                    "author": s.author,
+                    "story_type": s.story_type,
+                    # orjson tự serialize datetime thành chuỗi ISO-8601
+                    "created_at": s.created_at,
+                    "views": s.views,
+                    "is_hidden": s.is_hidden,
+                    "is_completed": s.is_completed,
+                    "rating_sum": s.rating_sum,
+                    "rating_count": s.rating_count,
+                    "category_id": s.category_id,
+                    "categories": [cat.id for cat in s.categories],
+                }
+                for s in Story.query.options(
+                    selectinload(Story.categories)
+                ).yield_per(500)
+            ),
+        )
+        yield from array(
+            "parts",
+            (
+                {
+                    "id": p.id,
+                    "story_id": p.story_id,
+                    "part_number": p.part_number,
+                    "content": p.content,
+                    "created_at": p.created_at,
+                }
+                for p in Part.query.yield_per(500)
+            ),
+        )
+        yield from array(
+            "comments",
+            (
+                {
+                    "id": c.id,
+                    "story_id": c.story_id,
+                    "url": c.url,
+                    "name": c.name,
+                    "email": c.email,
+                    "content": c.content,
+                    "created_at": c.created_at,
+                }
+                for c in Comment.query.yield_per(500)
+            ),
+        )
+        yield from array(
+            "videos",
+            (
+                {"id": v.id, "part_id": v.part_id, "url": v.url}
+                for v in PartVideo.query.yield_per(500)
+            ),
+            last=True,
+        )
+        yield b"}"
+
     filename = f"films_export_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.json"
-    return send_file(buf, as_attachment=True, download_name=filename, mimetype="application/json")
+    return Response(
+        stream_with_context(generate()),
+        mimetype="application/json",
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
 
 
 @app.route("/import_data", methods=["POST"])
@@ -1036,10 +1728,8 @@ def import_data():
     if not session.get("upload_authenticated"):
         return redirect(url_for("upload_login"))
 
-    # Kiểm tra mật khẩu gửi kèm
-    UPLOAD_PASSWORD = os.environ.get("UPLOAD_PASSWORD", "secret")
-    pw = request.form.get("password", "")
-    if pw != UPLOAD_PASSWORD:
+    # Kiểm tra mật khẩu gửi kèm (so sánh thời-gian-không-đổi)
+    if not check_upload_password(request.form.get("password", "")):
         flash("Mật khẩu không hợp lệ.")
         return redirect(url_for("upload"))
 
@@ -1048,7 +1738,7 @@ def import_data():
         flash("Không tìm thấy file để import.")
         return redirect(url_for("upload"))
     try:
-        data = json.load(uploaded_file)
+        data = orjson.loads(uploaded_file.read())
     except Exception:
         flash("File import không hợp lệ.")
         return redirect(url_for("upload"))
@@ -1058,65 +1748,81 @@ def import_data():
         if key not in data:
             data[key] = []
 
-    # Xác định tiêu đề truyện đã tồn tại trong cơ sở dữ liệu (không phân biệt chữ hoa/thường)
-    existing_titles = {s.title.lower() for s in Story.query.all()}
+    # Xác định tiêu đề truyện đã tồn tại trong cơ sở dữ liệu (không phân biệt
+    # chữ hoa/thường) bằng MỘT truy vấn IN trên lower(title) — chỉ so với các
+    # tiêu đề có trong file import thay vì tải toàn bộ bảng stories
+    incoming_titles = {
+        (st.get("title") or "").strip().lower() for st in data.get("stories", [])
+    }
+    existing_by_title = {
+        row.title.lower(): row.id
+        for row in db.session.execute(
+            select(Story.id, Story.title).where(
+                func.lower(Story.title).in_(incoming_titles)
+            )
+        )
+    }
     duplicates = []
     non_duplicates = []
     for st in data.get("stories", []):
         title = (st.get("title") or "").strip()
-        if title.lower() in existing_titles:
+        if title.lower() in existing_by_title:
             duplicates.append(st)
         else:
             non_duplicates.append(st)
 
     # Nếu có trùng tên, chuẩn bị danh sách chi tiết để hỏi người dùng
     if duplicates:
+        def make_snippet(content: str) -> str:
+            """Cắt 400 ký tự đầu của nội dung (đã bỏ xuống dòng) làm đoạn trích.
+
+            Cắt lát TRƯỚC khi thay thế xuống dòng để không copy cả chương dài
+            chỉ vì một đoạn trích; rfind thay cho rsplit để khỏi cấp phát list.
+            """
+            if not content:
+                return ""
+            head = content[:400].replace("\n", " ")
+            if len(content) <= 400:
+                return head
+            cut = head.rfind(" ")
+            return (head[:cut] if cut > 0 else head) + "..."
+
+        # Lập chỉ mục phần 1 trong file JSON một lần thay vì quét lại toàn bộ
+        # danh sách parts cho từng truyện trùng (O(D·P) → O(P+D))
+        json_first_parts = {
+            p.get("story_id"): p.get("content", "")
+            for p in data.get("parts", [])
+            if p.get("part_number") == 1
+        }
+        # Lấy phần 1 của tất cả truyện trùng trong DB bằng một truy vấn IN
+        db_first_parts = {
+            row.story_id: row.content
+            for row in db.session.execute(
+                select(Part.story_id, Part.content).where(
+                    Part.story_id.in_(list(existing_by_title.values())),
+                    Part.part_number == 1,
+                )
+            )
+        }
         duplicate_info_list = []
         for st in duplicates:
             json_id = st.get("id")
             title = st.get("title", "")
-            # Tìm phim hiện có trong DB
-            existing_story = Story.query.filter(func.lower(Story.title) == title.lower()).first()
-            # Lấy đoạn trích phần đầu tiên (phần 1) của phim trong DB
-            db_snippet = ""
-            if existing_story:
-                db_first_part = (
-                    Part.query.filter_by(story_id=existing_story.id)
-                    .order_by(Part.part_number)
-                    .first()
-                )
-                if db_first_part and db_first_part.content:
-                    db_text = db_first_part.content.replace("\n", " ")
-                    snippet = db_text[:400]
-                    if len(db_text) > 400:
-                        snippet = snippet.rsplit(" ", 1)[0] + "..."
-                    db_snippet = snippet
-            # Lấy đoạn trích phần đầu tiên của phim trong file JSON
-            json_snippet = ""
-            for p in data.get('parts', []):
-                if p.get('story_id') == json_id and p.get('part_number') == 1:
-                    content = (p.get('content') or "").replace("\n", " ")
-                    snippet = content[:400]
-                    if len(content) > 400:
-                        snippet = snippet.rsplit(" ", 1)[0] + "..."
-                    json_snippet = snippet
-                    break
+            # id phim hiện có lấy từ dict đã truy vấn ở trên, không query lại
+            db_story_id = existing_by_title.get(title.strip().lower())
             duplicate_info_list.append({
                 'json_id': json_id,
-                'db_id': existing_story.id if existing_story else None,
+                'db_id': db_story_id,
                 'title': title,
-                'db_snippet': db_snippet,
-                'json_snippet': json_snippet,
+                'db_snippet': make_snippet(db_first_parts.get(db_story_id, "")),
+                'json_snippet': make_snippet(json_first_parts.get(json_id, "")),
             })
         # Lưu dữ liệu import vào file tạm để sử dụng ở bước xác nhận
-        BASE_DIR = os.path.abspath(os.path.dirname(__file__))
-        DATA_DIR = os.path.abspath(os.path.join(BASE_DIR, os.pardir, "data"))
-        os.makedirs(DATA_DIR, exist_ok=True)
         temp_filename = f"import_{uuid.uuid4().hex}.json"
         temp_path = os.path.join(DATA_DIR, temp_filename)
         try:
-            with open(temp_path, 'w', encoding='utf8') as f:
-                json.dump(data, f, ensure_ascii=False)
+            with open(temp_path, 'wb') as f:
+                f.write(orjson.dumps(data))
         except Exception:
             flash("Không thể lưu tệp tạm thời để import.")
             return redirect(url_for("upload"))
@@ -1129,6 +1835,7 @@ def import_data():
         )
     # Không có trùng tên, thực hiện import trực tiếp
     imported_count, overwritten_count, skipped_count = perform_import(data, decisions=None)
+    invalidate_home_cache()
     flash(f"Import thành công {imported_count} truyện.")
     return redirect(url_for("upload"))
 
@@ -1144,10 +1851,8 @@ def import_confirm():
     """
     if not session.get("upload_authenticated"):
         return redirect(url_for("upload_login"))
-    # Kiểm tra mật khẩu gửi kèm
-    UPLOAD_PASSWORD = os.environ.get("UPLOAD_PASSWORD", "secret")
-    pw = request.form.get("password", "")
-    if pw != UPLOAD_PASSWORD:
+    # Kiểm tra mật khẩu gửi kèm (so sánh thời-gian-không-đổi)
+    if not check_upload_password(request.form.get("password", "")):
         flash("Mật khẩu không hợp lệ.")
         return redirect(url_for("upload"))
     temp_file = request.form.get("temp_file")
@@ -1169,12 +1874,10 @@ def import_confirm():
         for k in list(decisions.keys()):
             decisions[k] = "overwrite"
     # Đọc lại dữ liệu từ file tạm
-    BASE_DIR = os.path.abspath(os.path.dirname(__file__))
-    DATA_DIR = os.path.abspath(os.path.join(BASE_DIR, os.pardir, "data"))
     temp_path = os.path.join(DATA_DIR, temp_file)
     try:
-        with open(temp_path, 'r', encoding='utf8') as f:
-            data = json.load(f)
+        with open(temp_path, 'rb') as f:
+            data = orjson.loads(f.read())
     except Exception:
         flash("Không thể đọc dữ liệu import.")
         return redirect(url_for("upload"))
@@ -1187,6 +1890,7 @@ def import_confirm():
         if key not in data:
             data[key] = []
     imported_count, overwritten_count, skipped_count = perform_import(data, decisions)
+    invalidate_home_cache()
     flash(
         f"Import hoàn tất. Đã import {imported_count} phim, ghi đè {overwritten_count} và bỏ qua {skipped_count}."
     )
@@ -1211,6 +1915,15 @@ def perform_import(data: dict, decisions: dict[str, str] | None = None) -> tuple
     overwritten_count = 0
     skipped_count = 0
 
+    def parse_created_at(value: str | None) -> datetime:
+        """Đọc chuỗi ISO thành datetime, lỗi hoặc thiếu thì dùng thời điểm hiện tại."""
+        if value:
+            try:
+                return datetime.fromisoformat(value)
+            except Exception:
+                pass
+        return datetime.utcnow()
+
     # Tạo hoặc lấy các thể loại dựa trên tên (không phân biệt chữ hoa/thường).
     # Sử dụng bộ đệm tạm (existing_categories) để tránh tạo trùng nhiều lần
     # và tránh lỗi UNIQUE khi flush. Trước tiên thu thập tất cả tên thể loại
@@ -1256,19 +1969,25 @@ def perform_import(data: dict, decisions: dict[str, str] | None = None) -> tuple
                 existing_categories[lower_name] = cobj
             category_objs[cat.get("id")] = cobj
         db.session.flush()
-    # Commit thay đổi thể loại trước khi xử lý truyện
-    db.session.commit()
 
     # mapping từ id cũ sang id mới
     story_map: dict[int, int] = {}
     part_map: dict[int, int] = {}
 
-    # Import truyện
+    # Import truyện. Gom tất cả đối tượng mới rồi flush MỘT lần để cấp id,
+    # thay vì flush (một round-trip INSERT) cho từng truyện.
+    pending_stories: list[tuple[int, Story, list]] = []
     for st in data.get("stories", []):
         old_id = st.get("id")
         title = (st.get("title") or "").strip()
-        # Lấy quyết định: có thể là skip, overwrite hoặc None (mặc định là import)
-        decision = decisions.get(str(old_id)) or decisions.get(old_id)
+        # Lấy quyết định: có thể là skip, overwrite hoặc None (mặc định là
+        # import). Trường hợp thường gặp là không có truyện trùng tên nào,
+        # khi đó bỏ qua luôn hai lượt tra dict cho mỗi truyện.
+        decision = (
+            (decisions.get(str(old_id)) or decisions.get(old_id))
+            if decisions
+            else None
+        )
         # Bỏ qua truyện nếu được đánh dấu skip
         if decision == "skip":
             skipped_count += 1
@@ -1279,31 +1998,18 @@ def perform_import(data: dict, decisions: dict[str, str] | None = None) -> tuple
             if existing_story:
                 # Gỡ liên kết thể loại
                 existing_story.categories = []
-                # Xoá video của các phần
-                for part in existing_story.parts:
-                    PartVideo.query.filter_by(part_id=part.id).delete()
-                # Xoá các phần
-                Part.query.filter_by(story_id=existing_story.id).delete()
-                # Xoá bình luận
-                Comment.query.filter_by(story_id=existing_story.id).delete()
+                # Xoá video, chương và bình luận (mỗi bảng một câu DELETE)
+                delete_story_children(existing_story.id)
                 # Xoá truyện
                 db.session.delete(existing_story)
-                db.session.commit()
+                db.session.flush()
                 overwritten_count += 1
         # Tạo truyện mới (luôn tạo mới để tránh xung đột id)
-        created_at_str = st.get("created_at")
-        if created_at_str:
-            try:
-                created_at_dt = datetime.fromisoformat(created_at_str)
-            except Exception:
-                created_at_dt = datetime.utcnow()
-        else:
-            created_at_dt = datetime.utcnow()
         new_story = Story(
             title=st.get("title"),
             author=st.get("author"),
             story_type=st.get("story_type", "short"),
-            created_at=created_at_dt,
+            created_at=parse_created_at(st.get("created_at")),
             views=st.get("views", 0),
             is_hidden=st.get("is_hidden", False),
             is_completed=st.get("is_completed", False),
@@ -1311,96 +2017,105 @@ def perform_import(data: dict, decisions: dict[str, str] | None = None) -> tuple
             rating_count=st.get("rating_count", 0),
         )
         db.session.add(new_story)
-        db.session.flush()
-        story_map[old_id] = new_story.id
+        pending_stories.append((old_id, new_story, st.get("categories", [])))
         imported_count += 1
+    # một flush duy nhất cấp id cho tất cả truyện vừa thêm
+    db.session.flush()
+    for old_id, new_story, cat_ids in pending_stories:
+        story_map[old_id] = new_story.id
         # Thiết lập danh sách thể loại
-        cat_ids = st.get("categories", [])
         selected_cats = [category_objs[cid] for cid in cat_ids if cid in category_objs]
         new_story.categories = selected_cats
         # category_id gốc chỉ dùng để tham chiếu, đặt theo thể loại đầu tiên nếu có
-        if selected_cats:
-            new_story.category_id = selected_cats[0].id
-        else:
-            new_story.category_id = None
-        db.session.flush()
-    db.session.commit()
+        new_story.category_id = selected_cats[0].id if selected_cats else None
 
-    # Import các phần cho mỗi truyện
+    # Import các phần cho mỗi truyện; đồng thời ghi nhận thời điểm chương mới
+    # nhất của từng truyện để cập nhật cột denormalize Story.last_part_at
+    latest_part_at: dict[int, datetime] = {}
+    part_rows: list[dict] = []
+    old_part_ids: list[int] = []
     for part in data.get("parts", []):
         old_story_id = part.get("story_id")
         # Nếu truyện cũ không được import (do skip) thì bỏ qua phần
         if old_story_id not in story_map:
             continue
-        created_at_str = part.get("created_at")
-        if created_at_str:
-            try:
-                part_created = datetime.fromisoformat(created_at_str)
-            except Exception:
-                part_created = datetime.utcnow()
-        else:
-            part_created = datetime.utcnow()
-        new_part = Part(
-            story_id=story_map[old_story_id],
-            part_number=part.get("part_number"),
-            content=part.get("content", ""),
-            created_at=part_created,
+        part_created = parse_created_at(part.get("created_at"))
+        new_story_id = story_map[old_story_id]
+        part_rows.append({
+            "story_id": new_story_id,
+            "part_number": part.get("part_number"),
+            "content": part.get("content", ""),
+            "created_at": part_created,
+        })
+        old_part_ids.append(part.get("id"))
+        prev_latest = latest_part_at.get(new_story_id)
+        if prev_latest is None or part_created > prev_latest:
+            latest_part_at[new_story_id] = part_created
+    if part_rows:
+        # INSERT executemany một lần; RETURNING trả id mới theo đúng thứ tự
+        # tham số để ánh xạ lại với id cũ
+        result = db.session.execute(
+            db.insert(Part).returning(Part.id, sort_by_parameter_order=True),
+            part_rows,
+        )
+        part_map.update(zip(old_part_ids, (row[0] for row in result)))
+    for sid, latest in latest_part_at.items():
+        db.session.execute(
+            db.update(Story).where(Story.id == sid).values(last_part_at=latest)
         )
-        db.session.add(new_part)
-        db.session.flush()
-        part_map[part.get("id")] = new_part.id
-    db.session.commit()
 
     # Import bình luận (sử dụng id mới của truyện); cập nhật lại url nếu có chứa /story/<id>
+    comment_rows: list[dict] = []
     for c in data.get("comments", []):
         old_story_id = c.get("story_id")
         new_story_id = story_map.get(old_story_id)
         if not new_story_id:
             continue  # bỏ qua bình luận của truyện đã skip
-        created_at_str = c.get("created_at")
-        if created_at_str:
-            try:
-                c_created = datetime.fromisoformat(created_at_str)
-            except Exception:
-                c_created = datetime.utcnow()
-        else:
-            c_created = datetime.utcnow()
-        url = c.get("url", "")
-        try:
-            import re
-            url = re.sub(r"/story/(\d+)", lambda m: f"/story/{new_story_id}", url)
-        except Exception:
-            pass
-        new_comment = Comment(
-            story_id=new_story_id,
-            url=url,
-            name=c.get("name"),
-            email=c.get("email"),
-            content=c.get("content"),
-            created_at=c_created,
-        )
-        db.session.add(new_comment)
-    db.session.commit()
+        url = _STORY_URL_RE.sub(f"/story/{new_story_id}", c.get("url", "") or "")
+        comment_rows.append({
+            "story_id": new_story_id,
+            "url": url,
+            "name": c.get("name"),
+            "email": c.get("email"),
+            "content": c.get("content"),
+            "created_at": parse_created_at(c.get("created_at")),
+        })
+    if comment_rows:
+        db.session.execute(db.insert(Comment), comment_rows)
 
     # Import video liên kết cho các phần
-    for vid in data.get("videos", []):
-        old_part_id = vid.get("part_id")
-        new_part_id = part_map.get(old_part_id)
-        if not new_part_id:
-            continue
-        url = vid.get("url")
-        if url:
-            db.session.add(PartVideo(part_id=new_part_id, url=url))
-    db.session.commit()
+    video_rows = [
+        {"part_id": part_map[vid.get("part_id")], "url": vid.get("url")}
+        for vid in data.get("videos", [])
+        if vid.get("part_id") in part_map and vid.get("url")
+    ]
+    if video_rows:
+        db.session.execute(db.insert(PartVideo), video_rows)
+
+    # Toàn bộ import nằm trong MỘT transaction: một lần fsync duy nhất và
+    # import lỗi giữa chừng không để lại dữ liệu dở dang.
+    try:
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    invalidate_category_cache()
 
-    # Cập nhật sequence tự tăng khi sử dụng PostgreSQL
+    # Cập nhật sequence tự tăng khi sử dụng PostgreSQL. Gộp cả năm lệnh setval
+    # vào một khối DO để chỉ tốn một round-trip thay vì năm.
     if db.engine.dialect.name == "postgresql":
         with db.engine.connect() as conn:
-            conn.execute(text("SELECT setval(pg_get_serial_sequence('categories','id'), COALESCE((SELECT MAX(id) FROM categories), 1), true)"))
-            conn.execute(text("SELECT setval(pg_get_serial_sequence('stories','id'), COALESCE((SELECT MAX(id) FROM stories), 1), true)"))
-            conn.execute(text("SELECT setval(pg_get_serial_sequence('parts','id'), COALESCE((SELECT MAX(id) FROM parts), 1), true)"))
-            conn.execute(text("SELECT setval(pg_get_serial_sequence('comments','id'), COALESCE((SELECT MAX(id) FROM comments), 1), true)"))
-            conn.execute(text("SELECT setval(pg_get_serial_sequence('part_videos','id'), COALESCE((SELECT MAX(id) FROM part_videos), 1), true)"))
+            conn.execute(text(
+                """
+                DO $$ BEGIN
+                    PERFORM setval(pg_get_serial_sequence('categories','id'), COALESCE((SELECT MAX(id) FROM categories), 1), true);
+                    PERFORM setval(pg_get_serial_sequence('stories','id'), COALESCE((SELECT MAX(id) FROM stories), 1), true);
+                    PERFORM setval(pg_get_serial_sequence('parts','id'), COALESCE((SELECT MAX(id) FROM parts), 1), true);
+                    PERFORM setval(pg_get_serial_sequence('comments','id'), COALESCE((SELECT MAX(id) FROM comments), 1), true);
+                    PERFORM setval(pg_get_serial_sequence('part_videos','id'), COALESCE((SELECT MAX(id) FROM part_videos), 1), true);
+                END $$
+                """
+            ))
     return imported_count, overwritten_count, skipped_count
 
 
@@ -1420,11 +2135,12 @@ def delete_all_stories():
     # Kiểm tra quyền truy cập
     if not session.get("upload_authenticated"):
         return redirect(url_for("upload_login"))
-    # Mật khẩu upload để xác thực hành động xoá
-    UPLOAD_PASSWORD = os.environ.get("UPLOAD_PASSWORD", "secret")
+    # Mật khẩu upload để xác thực hành động xoá (so sánh thời-gian-không-đổi)
     pw1 = request.form.get("password1", "")
     pw2 = request.form.get("password2", "")
-    if not pw1 or not pw2 or pw1 != pw2 or pw1 != UPLOAD_PASSWORD:
+    # encode trước khi so sánh: compare_digest trên str raise TypeError với
+    # ký tự ngoài ASCII (mật khẩu tiếng Việt có dấu), trên bytes thì không
+    if not pw1 or not pw2 or not hmac.compare_digest(pw1.encode(), pw2.encode()) or not check_upload_password(pw1):
         flash("Mật khẩu không hợp lệ hoặc hai mật khẩu không khớp.")
         return redirect(url_for("upload"))
     # Xoá toàn bộ dữ liệu liên quan tới truyện, bao gồm cả video và bình luận
@@ -1440,6 +2156,7 @@ def delete_all_stories():
         # Xoá truyện
         Story.query.delete()
         db.session.commit()
+        invalidate_home_cache()
         flash("Đã xoá toàn bộ truyện thành công!")
     except Exception:
         db.session.rollback()
@@ -1457,7 +2174,7 @@ def category_view(category_id: int):
     Tham số ``page`` trên URL dùng để chuyển trang. Trả về template list.html để
     hiển thị danh sách.
     """
-    category = Category.query.get_or_404(category_id)
+    category = db.get_or_404(Category, category_id)
     page = request.args.get("page", 1, type=int)
     per_page = 25
     query = (
@@ -1522,25 +2239,34 @@ def author_view(author: str):
 
 
 @app.route("/type/<story_type>")
+@cache.cached(timeout=300, key_prefix=page_cache_key, unless=has_pending_flash)
 def type_view(story_type: str):
-    """Hiển thị danh sách truyện theo loại ngắn/dài."""
+    """Hiển thị danh sách truyện theo loại ngắn/dài (cache nguyên trang HTML).
+
+    Trang này chỉ thay đổi khi truyện được thêm/sửa/ẩn; các thao tác đó gọi
+    invalidate_home_cache() nên bản cache được làm mới ngay sau khi ghi.
+    """
     if story_type not in ("short", "long"):
         return page_not_found(404)
     page = request.args.get("page", 1, type=int)
     per_page = 25
     query = (
-        Story.query.filter_by(story_type=story_type, is_hidden=False)
+        Story.query.options(*story_list_options())
+        .filter_by(story_type=story_type, is_hidden=False)
         .order_by(Story.created_at.desc())
     )
-    pagination = query.paginate(page=page, per_page=per_page, error_out=False)
+    # lấy per_page + 1 dòng thay vì chạy COUNT trên cả bảng mỗi lượt xem;
+    # tổng số trang (cho nút "trang cuối") tính từ câu đếm đã cache 60 giây
+    pagination = paginate_without_count(query, page, per_page)
     stories = pagination.items
+    total_pages = max(1, -(-count_type_stories(story_type) // per_page))
     categories = get_sorted_categories()
     # xác định tiêu đề tiếng Việt cho phim
     title_vi = "Phim Ngắn" if story_type == "short" else "Phim Dài"
     first_url = url_for("type_view", story_type=story_type, page=1) if pagination.page > 1 else None
     prev_url = url_for("type_view", story_type=story_type, page=pagination.prev_num) if pagination.has_prev else None
     next_url = url_for("type_view", story_type=story_type, page=pagination.next_num) if pagination.has_next else None
-    last_url = url_for("type_view", story_type=story_type, page=pagination.pages) if pagination.page < pagination.pages else None
+    last_url = url_for("type_view", story_type=story_type, page=total_pages) if pagination.page < total_pages else None
     return render_template(
         "list.html",
         title=title_vi,
@@ -1563,27 +2289,100 @@ def search():
     Nhận tham số q trên URL, trả về danh sách truyện phù hợp.
     """
     query = request.args.get("q", "").strip()
+    page = request.args.get("page", 1, type=int)
     stories = []
+    pagination = None
     if query:
-        # tìm theo tiêu đề, tác giả hoặc nội dung phần truyện và loại bỏ truyện ẩn.
-        like_pattern = f"%{query}%"
-        stories = (
-            Story.query.outerjoin(Part)
-            .filter(
-                (Story.title.ilike(like_pattern))
-                | (Story.author.ilike(like_pattern))
-                | (Part.content.ilike(like_pattern))
+        # Đường tắt cho từ khoá một từ (>= 3 ký tự): nếu có truyện mà tiêu đề
+        # hoặc tác giả bắt đầu bằng từ khoá thì trả về các truyện đó qua
+        # LIKE 'q%' — chạy hoàn toàn trên index B-tree lower(title)/lower(author)
+        # (varchar_pattern_ops trên PostgreSQL), không phải động tới nội dung
+        # chương. Thăm dò bằng một câu LIMIT 1 trước để từ khoá không có kết
+        # quả tiền tố vẫn rơi xuống nhánh tìm kiếm đầy đủ bên dưới.
+        prefix_filter = None
+        if " " not in query and len(query) >= 3:
+            lowered = query.lower()
+            prefix_filter = (
+                func.lower(Story.title).like(lowered + "%")
+                | func.lower(Story.author).like(lowered + "%")
             )
-            .filter(Story.is_hidden == False)
-            .distinct()
-            .order_by(Story.created_at.desc())
-            .all()
-        )
+            has_prefix_hit = (
+                db.session.execute(
+                    select(Story.id)
+                    .where(prefix_filter, Story.is_hidden == False)
+                    .limit(1)
+                ).first()
+                is not None
+            )
+            if not has_prefix_hit:
+                prefix_filter = None
+        if prefix_filter is not None:
+            stories_query = (
+                Story.query.options(*story_list_options())
+                .filter(prefix_filter)
+                .filter(Story.is_hidden == False)
+                .order_by(Story.created_at.desc())
+            )
+        elif db.engine.dialect.name == "postgresql":
+            # Trên PostgreSQL dùng full-text search: tsvector @@ tsquery đi qua
+            # index GIN (xem upgrade_db_postgres) thay vì ILIKE quét toàn bộ
+            # nội dung chương. Chương khớp được gom bằng subquery IN nên không
+            # cần outer join + DISTINCT.
+            # bỏ dấu cả từ khoá lẫn nội dung để "truyen" khớp được "truyện".
+            # websearch_to_tsquery hiểu cú pháp người dùng gõ tự nhiên
+            # ("cụm từ", OR, -loại trừ) thay vì AND tất cả như plainto_tsquery.
+            ts_query = func.websearch_to_tsquery("simple", func.f_unaccent(query))
+            matched_story_ids = (
+                select(Part.story_id)
+                .where(_part_search_vector().op("@@")(ts_query))
+                .scalar_subquery()
+            )
+            stories_query = (
+                Story.query.options(*story_list_options())
+                .filter(
+                    _story_search_vector().op("@@")(ts_query)
+                    | Story.id.in_(matched_story_ids)
+                )
+                .filter(Story.is_hidden == False)
+                # truyện khớp ngay tiêu đề/tác giả xếp trước (ts_rank_cd > 0),
+                # trong cùng hạng thì truyện mới hơn đứng trước
+                .order_by(
+                    func.ts_rank_cd(_story_search_vector(), ts_query).desc(),
+                    Story.created_at.desc(),
+                )
+            )
+        else:
+            # SQLite (môi trường phát triển) không có tsvector: giữ ILIKE.
+            # Chương khớp được kiểm tra bằng EXISTS (semi-join) thay vì outer
+            # join + DISTINCT: mỗi truyện chỉ xuất hiện một lần một cách tự
+            # nhiên, không phải sắp xếp/khử trùng toàn bộ tập kết quả join
+            # trước khi LIMIT có tác dụng.
+            like_pattern = f"%{query}%"
+            part_match = (
+                select(Part.id)
+                .where(Part.story_id == Story.id, Part.content.ilike(like_pattern))
+                .exists()
+            )
+            stories_query = (
+                Story.query.options(*story_list_options())
+                .filter(
+                    (Story.title.ilike(like_pattern))
+                    | (Story.author.ilike(like_pattern))
+                    | part_match
+                )
+                .filter(Story.is_hidden == False)
+                .order_by(Story.created_at.desc())
+            )
+        # Phân trang không cần COUNT: mỗi trang tối đa 25 kết quả thay vì
+        # nạp mọi truyện khớp (kèm toàn bộ chương của chúng) vào bộ nhớ.
+        pagination = paginate_without_count(stories_query, page, 25)
+        stories = pagination.items
     categories = get_sorted_categories()
     return render_template(
         "search.html",
         query=query,
         stories=stories,
+        pagination=pagination,
         categories=categories,
     )
 
@@ -1592,15 +2391,24 @@ def search():
 @app.route("/rate/<int:story_id>", methods=["POST"])
 def rate_story(story_id: int):
     """Xử lý đánh giá truyện. Người đọc gửi rating từ 1 tới 5."""
-    story = Story.query.get_or_404(story_id)
     try:
         rating_value = int(request.form.get("rating", 0))
     except ValueError:
         rating_value = 0
     # chỉ chấp nhận giá trị từ 1 đến 5
     if 1 <= rating_value <= 5:
-        story.rating_sum = (story.rating_sum or 0) + rating_value
-        story.rating_count = (story.rating_count or 0) + 1
+        # UPDATE nguyên tử ngay trong CSDL (giống bộ đếm lượt xem): không cần
+        # SELECT cả dòng trước và hai đánh giá đồng thời không ghi đè nhau
+        result = db.session.execute(
+            db.update(Story)
+            .where(Story.id == story_id)
+            .values(
+                rating_sum=func.coalesce(Story.rating_sum, 0) + rating_value,
+                rating_count=func.coalesce(Story.rating_count, 0) + 1,
+            )
+        )
+        if result.rowcount == 0:
+            abort(404)
         db.session.commit()
     return redirect(url_for("story_detail", story_id=story_id))
 
@@ -1614,15 +2422,14 @@ def add_category():
     """
     categories = get_sorted_categories()
     if request.method == "POST":
-        UPLOAD_PASSWORD = os.environ.get("UPLOAD_PASSWORD", "secret")
         password = request.form.get("password", "")
         action = request.form.get("action", "create")
         category_id = request.form.get("category_id")
         name = request.form.get("name", "").strip()
         # hỗ trợ nhập nhiều tên thể loại cùng lúc (danh sách names)
         names = request.form.getlist("names")
-        # kiểm tra mật khẩu
-        if password != UPLOAD_PASSWORD:
+        # kiểm tra mật khẩu (so sánh thời-gian-không-đổi)
+        if not check_upload_password(password):
             return render_template(
                 "add_category.html",
                 error="Password sai.",
@@ -1631,23 +2438,34 @@ def add_category():
         # xử lý xoá
         if action == "delete":
             if category_id:
-                cat = Category.query.get(int(category_id))
-                if cat:
-                    # nếu thể loại đang được dùng, không cho xoá
-                    # nếu thể loại liên kết với truyện qua quan hệ một‑nhiều hoặc nhiều‑nhiều thì không xoá
-                    if cat.stories or getattr(cat, "stories_multi", []):
-                        return render_template(
-                            "add_category.html",
-                            error="Không thể xoá thể loại đang được sử dụng.",
-                            categories=categories,
-                        )
-                    db.session.delete(cat)
-                    db.session.commit()
-                    return redirect(url_for("add_category"))
+                # gộp bước kiểm tra "đang được dùng" vào chính câu DELETE bằng
+                # NOT EXISTS: một round-trip thay vì SELECT rồi mới DELETE, và
+                # CSDL đảm bảo nguyên tử — không còn khe đua nếu có truyện vừa
+                # được gán thể loại giữa lúc kiểm tra và lúc xoá
+                result = db.session.execute(
+                    db.delete(Category).where(
+                        Category.id == int(category_id),
+                        ~select(Story.id)
+                        .where(Story.category_id == Category.id)
+                        .exists(),
+                        ~select(story_categories.c.story_id)
+                        .where(story_categories.c.category_id == Category.id)
+                        .exists(),
+                    )
+                )
+                db.session.commit()
+                if result.rowcount == 0:
+                    return render_template(
+                        "add_category.html",
+                        error="Không thể xoá thể loại đang được sử dụng.",
+                        categories=categories,
+                    )
+                invalidate_category_cache()
+                return redirect(url_for("add_category"))
         # xử lý cập nhật
         elif action == "update":
             if category_id and name:
-                cat = Category.query.get(int(category_id))
+                cat = db.session.get(Category, int(category_id))
                 if cat:
                     existing = Category.query.filter_by(name=name).first()
                     if existing and existing.id != cat.id:
@@ -1658,23 +2476,40 @@ def add_category():
                         )
                     cat.name = name
                     db.session.commit()
+                    invalidate_category_cache()
                     return redirect(url_for("add_category"))
         # xử lý tạo mới
         else:
             # ưu tiên danh sách nhiều tên thể loại nếu được gửi từ form
             # nếu có ít nhất một tên trong danh sách, xử lý từng tên
             if names and any(n.strip() for n in names):
-                added_any = False
-                for nm in names:
-                    nm_strip = nm.strip()
-                    if not nm_strip:
-                        continue
-                    existing = Category.query.filter_by(name=nm_strip).first()
-                    if existing is None:
-                        db.session.add(Category(name=nm_strip))
-                        added_any = True
-                if added_any:
+                # kiểm tra trùng tên bằng MỘT truy vấn IN rồi chèn phần còn
+                # thiếu bằng một câu INSERT executemany, thay vì một cặp
+                # SELECT + INSERT cho từng tên
+                wanted = {nm.strip() for nm in names if nm.strip()}
+                existing_names = {
+                    row[0]
+                    for row in db.session.execute(
+                        select(Category.name).where(Category.name.in_(wanted))
+                    )
+                }
+                to_add = wanted - existing_names
+                if to_add:
+                    # một câu INSERT nhiều VALUES kèm ON CONFLICT DO NOTHING
+                    # trên UNIQUE(name): vừa một round-trip cho mọi N, vừa
+                    # đóng khe đua giữa bước kiểm tra trùng và bước chèn
+                    insert_fn = (
+                        pg_insert
+                        if db.engine.dialect.name == "postgresql"
+                        else sqlite_insert
+                    )
+                    db.session.execute(
+                        insert_fn(Category)
+                        .values([{"name": n} for n in sorted(to_add)])
+                        .on_conflict_do_nothing(index_elements=["name"])
+                    )
                     db.session.commit()
+                    invalidate_category_cache()
                     return redirect(url_for("add_category"))
                 else:
                     # tất cả các thể loại đã tồn tại
@@ -1685,12 +2520,16 @@ def add_category():
                     )
             # nếu không có danh sách, fallback dùng một tên
             elif name:
-                existing = Category.query.filter_by(name=name).first()
-                if existing is None:
+                # để UNIQUE(name) của CSDL bắt trùng thay vì SELECT kiểm tra
+                # trước: đường đi thường (tên mới) chỉ tốn đúng một câu INSERT
+                # và không có khe đua giữa kiểm tra và chèn
+                try:
                     db.session.add(Category(name=name))
                     db.session.commit()
+                    invalidate_category_cache()
                     return redirect(url_for("add_category"))
-                else:
+                except IntegrityError:
+                    db.session.rollback()
                     return render_template(
                         "add_category.html",
                         error="Thể loại đã tồn tại.",
@@ -1736,7 +2575,7 @@ def api_category_stories(category_id: int):
     limit = request.args.get("limit", 25, type=int)
     if limit <= 0:
         limit = 25
-    category = Category.query.get_or_404(category_id)
+    category = db.get_or_404(Category, category_id)
     query = (
         Story.query.join(story_categories)
         .filter(